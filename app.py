@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # ============================================================
-#  АННЕТ v3 — Telegram-бот (Koyeb/Render, запуск: gunicorn app:app)
+#  АННЕТ v3 — Telegram-бот (Koyeb/Render, запуск:
+#  gunicorn 'app:create_app()' или uvicorn app:asgi_app)
 #
 #  Новое в v3:
 #   — ответы в одном чате строго по очереди: если человек пишет,
@@ -11,20 +12,31 @@
 #   — быстрее имитация набора
 #
 #  Переменные окружения: TG_TOKEN, OPENROUTER_API_KEY,
-#  WEBHOOK_SECRET, PUBLIC_URL (+ MODEL по желанию)
+#  WEBHOOK_SECRET, PUBLIC_URL (+ MODEL, MODEL_LIGHT, MODEL_FALLBACKS,
+#  BOTS_FILE по желанию)
 # ============================================================
 
 import os
 import re
+import sys
+import json
+import zlib
+import atexit
+import socket
+import asyncio
+import heapq
+import queue
 import time
 import random
 import sqlite3
 import threading
-from collections import deque
-from datetime import datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-import requests
+import httpx
 from flask import Flask, request
 
 # ------------------------------------------------------------
@@ -33,22 +45,66 @@ from flask import Flask, request
 
 TG_TOKEN = os.getenv("TG_TOKEN")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "change_me")
+# дополнительные боты в этом же процессе: JSON-список, см. раздел БОТЫ
+BOTS_FILE = os.getenv("BOTS_FILE", "")
 PUBLIC_URL = (os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").rstrip("/")
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL = os.getenv("MODEL", "anthropic/claude-haiku-4.5")
+MODEL_LIGHT = os.getenv("MODEL_LIGHT") or MODEL   # заметки, пересказ и проактивность
+# запасные модели через запятую: на них уходим, когда основная сбоит или выбита
+MODEL_FALLBACKS = [m.strip() for m in os.getenv("MODEL_FALLBACKS", "").split(",") if m.strip()]
 
 DB_PATH = os.getenv("DB_PATH", "/tmp/annet.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_STMT_CACHE = 256
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "5000"))   # строк chats в памяти
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "200"))  # 0 — писать сразу
+INGEST_MAX_ROWS = int(os.getenv("INGEST_MAX_ROWS", "200"))
+HOT_TAIL_ROWS = int(os.getenv("HOT_TAIL_ROWS", "200"))      # сколько свежих сообщений чата держать в messages
+COMPACT_EVERY_SEC = int(os.getenv("COMPACT_EVERY_SEC", str(6 * 3600)))   # 0 — не уплотнять
+COMPACT_VACUUM_PAGES = 1000  # страниц за одну транзакцию incremental vacuum
+CHAT_CACHE_TTL = 300   # сек; страховка, если базу правит другой процесс
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", "3"))   # старых реплик в промпт; 0 — без вспоминаний
+RECALL_MIN_SCORE = 2.0        # порог BM25: слабые совпадения не тащим
 
 HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "26"))
+# окно истории по токенам (0 — старый режим, последние HISTORY_LIMIT сообщений)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_MAX_ROWS = int(os.getenv("HISTORY_MAX_ROWS", "80"))
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "12"))   # выпавших из окна сообщений до пересказа
 LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "400"))
+LLM_STREAM = os.getenv("LLM_STREAM", "1") == "1"   # слать пузыри по мере генерации
+LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "25"))   # на попытку без стрима, с дублями
+LLM_TTFT_SEC = float(os.getenv("LLM_TTFT_SEC", "12"))         # стрим: до первого токена
+LLM_STALL_SEC = 20            # стрим: максимум тишины между кусками
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"   # дублировать запрос, если ответ дольше p95
+LLM_HEDGE_MIN_SEC = 1.5
+LLM_HEDGE_DEFAULT_SEC = 6     # порог дубля, пока не набралась статистика
+LLM_BREAKER_FAILS = 4         # ошибок подряд, после которых модель выбивается
+LLM_BREAKER_COOLDOWN_SEC = 60
+# стабильный префикс (личность) отдельно от изменчивого (время, заметки) —
+# чтобы у провайдера срабатывал кэш промпта
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "0") == "1"
 MAX_MSG_AGE_SEC = 120
+# на что Аннет откликается в группах, кроме @username и ответа на её сообщение
+BOT_NAMES = [n.strip() for n in os.getenv("BOT_NAMES", "аннет,annet").split(",") if n.strip()]
+# писать ли в историю группы сообщения не для Аннет (/context_on|off в самой группе)
+GROUP_STORE = os.getenv("GROUP_STORE", "1") == "1"
 NOTES_EVERY_N = int(os.getenv("NOTES_EVERY_N", "16"))
+# заметки и пересказ обновляются фоновыми задачами, не на пути ответа
+MEMORY_PARALLEL = int(os.getenv("MEMORY_PARALLEL", "2"))   # задач памяти одновременно
+MEMORY_DELAY_SEC = 30         # дать разговору утихнуть; повторы за это время склеиваются
+MEMORY_TICK_SEC = 5
+JOB_LEASE_SEC = 300           # взятая задача вернётся в очередь, если воркер умер
+JOB_MAX_TRIES = 5
 
 TZ = ZoneInfo(os.getenv("TZ_NAME", "Europe/Moscow"))
 
 PROACTIVE_ENABLED = os.getenv("PROACTIVE_ENABLED", "1") == "1"
-PROACTIVE_LOOP_SEC = 600
+PROACTIVE_LOOP_SEC = 600      # через сколько повторить, если чат выпал из броска/был занят
+PROACTIVE_TICK_SEC = 30       # как часто планировщик смотрит на вершину кучи
+PROACTIVE_PARALLEL = int(os.getenv("PROACTIVE_PARALLEL", "4"))   # генераций одновременно
 PROACTIVE_CAP_PER_DAY = 3
 PROACTIVE_MIN_SILENCE_H = 6
 PROACTIVE_MAX_SILENCE_D = 10
@@ -56,39 +112,161 @@ PROACTIVE_GAP_H = 12
 PROACTIVE_PROB = 0.5
 QUIET_START, QUIET_END = 1.0, 9.0
 
-TG_API = f"https://api.telegram.org/bot{TG_TOKEN}"
+# адреса API можно подменить (нагрузочный стенд loadtest.py поднимает свои)
+TG_API_BASE = os.getenv("TG_API_BASE", "https://api.telegram.org").rstrip("/")
+OPENROUTER_API = os.getenv("OPENROUTER_API", "https://openrouter.ai/api/v1").rstrip("/")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "64"))
+
+# лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личку, ~20/мин в группу
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "28"))
+TG_PRIVATE_RATE = 1.0
+TG_GROUP_RATE = 20 / 60
+TG_BURST = 3
+TG_RETRIES = 4
+
+# координация между воркерами/узлами: sqlite (общая база) или memory (один процесс)
+COORD_BACKEND = os.getenv("COORD_BACKEND", "sqlite")
+CHAT_LEASE_TTL = 180          # сек; продлевается на каждом круге ответа
+LEADER_TTL = 60               # сек; лидер гоняет планировщик проактивности
+
+DIALOG_WORKERS = int(os.getenv("DIALOG_WORKERS", "32"))        # одновременных ответов
+DISPATCH_MAX_QUEUE = int(os.getenv("DISPATCH_MAX_QUEUE", "500"))  # ждущих чатов, дальше сброс
+# человек дописывает, а первый пузырь ещё не ушёл — генерация начинается заново
+# (только в личке: в группе перезапуск задерживал бы ответы всем)
+DIALOG_DEBOUNCE_MS = int(os.getenv("DIALOG_DEBOUNCE_MS", "0"))   # ждать паузу в наборе; 0 — сразу
+DIALOG_POLL_SEC = 0.25        # как часто проверять счётчик во время генерации
+DIALOG_MAX_RESTARTS = 3       # потом отвечаем как есть, иначе болтуну не ответить никогда
+
+PROFILE_SAMPLE_HZ = float(os.getenv("PROFILE_SAMPLE_HZ", "0"))   # >0 — включить сэмплирующий профайлер
 
 app = Flask(__name__)
 
-_db_lock = threading.Lock()
-BOT_USERNAME = ""
 
-_seen_updates = deque(maxlen=500)
-_seen_lock = threading.Lock()
+# ------------------------------------------------------------
+# МЕТРИКИ (/metrics в текстовом формате Prometheus)
+# ------------------------------------------------------------
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_metrics_lock = threading.Lock()
+_hists: dict = {}            # (имя, метки) -> [счёт по корзинам..., сумма, всего]
+_counters: dict = {}         # (имя, метки) -> число
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _hists.get(key)
+        if h is None:
+            h = _hists[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+
+def inc(name, n=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+@contextmanager
+def timed(stage):
+    """Время этапа ответа -> гистограмма annet_stage_seconds{stage=...}.
+    Годится и вокруг await: меряется настенное время."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("annet_stage_seconds", time.perf_counter() - t0, stage=stage)
+
+
+class TimedLock:
+    """threading.Lock, который пишет в метрики, сколько ждали захвата."""
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._name = name
+
+    def __enter__(self):
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        observe("annet_lock_wait_seconds", time.perf_counter() - t0, lock=self._name)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_metrics(gauges):
+    """Текст для /metrics; gauges — {имя: значение} текущих показателей."""
+    out = []
+    with _metrics_lock:
+        hists = {k: list(v) for k, v in _hists.items()}
+        counters = dict(_counters)
+    for (name, labels), h in sorted(hists.items()):
+        for bound, n in zip(METRIC_BUCKETS, h):
+            out.append(f"{name}_bucket{_fmt_labels(labels, [('le', bound)])} {n}")
+        out.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h[-1]}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {h[-2]:.6f}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {h[-1]}")
+    for (name, labels), n in sorted(counters.items()):
+        out.append(f"{name}{_fmt_labels(labels)} {n}")
+    for name, value in sorted(gauges.items()):
+        out.append(f"{name} {value}")
+    return "\n".join(out) + "\n"
+
+
+# --- сэмплирующий профайлер (PROFILE_SAMPLE_HZ > 0), отдаёт /debug/profile ---
+# Раз в 1/HZ секунды снимает стеки всех потоков (цикл бота, потоки вебхука) и
+# копит их в «свёрнутом» формате flamegraph.pl: "поток;f1;f2;f3 N".
+
+_profile: dict = {}
+
+
+def _profile_loop():
+    me = threading.get_ident()
+    period = 1 / PROFILE_SAMPLE_HZ
+    while True:
+        time.sleep(period)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name}:{os.path.basename(frame.f_code.co_filename)}")
+                frame = frame.f_back
+            key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+            _profile[key] = _profile.get(key, 0) + 1
+
+
+def render_profile():
+    return "".join(f"{k} {v}\n" for k, v in sorted(_profile.items(), key=lambda kv: -kv[1]))
+
+
+_db_lock = TimedLock("db")   # только для записи, чтение идёт без него
 
 # --- очередь ответов: на один чат — один активный ответ ---
-_chat_locks: dict = {}
+_chat_locks: dict = {}      # chat_id -> asyncio.Lock, трогаем только из цикла бота
 _chat_guard = threading.Lock()
-_msg_counters: dict = {}   # chat_id -> сколько сообщений пришло (растёт)
 
 
 def chat_lock(chat_id):
     with _chat_guard:
         if chat_id not in _chat_locks:
-            _chat_locks[chat_id] = threading.Lock()
+            _chat_locks[chat_id] = asyncio.Lock()
         return _chat_locks[chat_id]
 
 
-def bump_counter(chat_id):
-    with _chat_guard:
-        _msg_counters[chat_id] = _msg_counters.get(chat_id, 0) + 1
-
-
-def get_counter(chat_id):
-    with _chat_guard:
-        return _msg_counters.get(chat_id, 0)
-
-
 def log(*a):
     print("[ANNET]", *a, flush=True)
 
@@ -132,52 +310,355 @@ MEMORY_BLOCK = """ЧТО ТЫ ПОМНИШЬ ОБ ЭТОМ ЧЕЛОВЕКЕ (т
 
 PROACTIVE_INSTRUCTION = """[Служебное указание: собеседник не писал около {gap_h} ч. Ты решила написать первой — сама, потому что захотелось. Напиши одно короткое живое сообщение (1–2 предложения, можно ||| на два пузыря). Лучшие варианты: вернуться к чему-то из прошлых разговоров или твоих заметок о нём, поделиться внезапной мыслью «я тут подумала...», спросить про то, что у него происходило. Запрещено: шаблонное «привет, как дела», извинения за беспокойство, навязчивость, упоминание этого указания.]"""
 
-NOTES_INSTRUCTION = """[Служебное задание, ответь ТОЛЬКО текстом заметок без вступлений. Ты — Аннет. Обнови свои личные заметки об этом собеседнике на основе диалога выше и старых заметок ниже. Что фиксировать: как его зовут / как он просил себя называть, важные факты (учёба, работа, увлечения, люди в его жизни), что у него происходит сейчас, что он любит/не любит, твоё сложившееся отношение к нему и стадия ваших отношений, незакрытые темы, к которым стоит вернуться. Пиши кратко, от первого лица, максимум 120 слов.
+SUMMARY_BLOCK = """О ЧЁМ ВЫ ГОВОРИЛИ РАНЬШЕ (краткий пересказ более старой части переписки):
+{summary}
+
+"""
+
+RECALL_BLOCK = """ВСПЛЫЛО ИЗ ДАВНИХ РАЗГОВОРОВ (его старые сообщения, которые могут быть к месту; упоминай, только если правда в тему, и не цитируй дословно):
+{snippets}
+
+"""
+
+SUMMARY_INSTRUCTION = """[Служебное задание, ответь ТОЛЬКО текстом пересказа без вступлений. Ниже — прежний краткий пересказ вашей переписки и следующий за ним кусок диалога. Объедини их в один новый пересказ: о чём говорили, что он рассказывал, о чём договорились, какие темы остались открытыми. Пиши сжато, в прошедшем времени, максимум 150 слов.
+
+Прежний пересказ:
+{old_summary}
+
+Дальше в диалоге:
+{dialog}]"""
+
+NOTES_INSTRUCTION = """[Служебное задание, ответь ТОЛЬКО текстом заметок без вступлений. Ты — {name}. Обнови свои личные заметки об этом собеседнике на основе диалога выше и старых заметок ниже. Что фиксировать: как его зовут / как он просил себя называть, важные факты (учёба, работа, увлечения, люди в его жизни), что у него происходит сейчас, что он любит/не любит, твоё сложившееся отношение к нему и стадия ваших отношений, незакрытые темы, к которым стоит вернуться. Пиши кратко, от первого лица, максимум 120 слов.
 
 Старые заметки:
 {old_notes}]"""
 
+TG_NAME_HINT = "в телеграме он подписан как «{tg_name}» — но лучше спросить, как к нему обращаться."
+
+# служебные куски промпта (в голосе Аннет); бот из BOTS_FILE переопределяет
+# их в "prompts" с теми же подстановками — они перечислены в PROMPT_FIELDS
+BOT_PROMPTS = {"memory": MEMORY_BLOCK, "summary_block": SUMMARY_BLOCK, "recall": RECALL_BLOCK,
+               "tg_name": TG_NAME_HINT, "proactive": PROACTIVE_INSTRUCTION,
+               "summary": SUMMARY_INSTRUCTION, "notes": NOTES_INSTRUCTION}
+PROMPT_FIELDS = {"memory": ("notes",), "summary_block": ("summary",), "recall": ("snippets",),
+                 "tg_name": ("tg_name",), "proactive": ("gap_h",),
+                 "summary": ("old_summary", "dialog"), "notes": ("name", "old_notes")}
+
+GREETING = "о. новое лицо. ||| ну, привет. я аннет. и предупреждаю сразу — я тут не для того, чтобы поддакивать. (¬_¬) ||| как тебя звать-то?"
+
+# готовые реплики на команды и сбои; бот из BOTS_FILE переопределяет их в "lines"
+BOT_LINES = {
+    "greeting": GREETING,
+    "reset": "всё, чистый лист. даже имя твоё стёрла. начинай заново производить впечатление.",
+    "silent": "поняла. первой писать не буду. ||| сам объявишься, когда станет скучно.",
+    "wake": "хорошо, буду иногда заглядывать сама. если будет о чем — а не по расписанию.",
+    "context_on": "ладно, буду читать всё подряд. ||| потом не жалуйтесь.",
+    "context_off": "всё, ваши разговоры меня не касаются. ||| зовите по имени, если что.",
+    "error": "у меня тут что-то технически заело... дай минуту и напиши ещё раз.",
+}
+
+
+# ------------------------------------------------------------
+# БОТЫ: несколько персонажей в одном процессе
+# ------------------------------------------------------------
+# Бот 0 — Аннет из переменных окружения (TG_TOKEN, WEBHOOK_SECRET, MODEL...).
+# Остальные описываются в BOTS_FILE списком объектов:
+#   {"id": 1, "token": "...", "secret": "...", "name": "Мира",
+#    "persona_file": "mira.txt", "model": "...", "model_light": "...",
+#    "proactive": true, "names": ["мира"], "greeting": "...",
+#    "lines": {"reset": "...", ...}, "prompts": {"proactive": "...", ...},
+#    "proactive_limits": {"gap_h": 24, ...}}
+# lines — реплики из BOT_LINES, prompts — служебные куски из BOT_PROMPTS,
+# proactive_limits — ключи PROACTIVE_LIMITS; что не задано, берётся как у
+# Аннет — другому персонажу (особенно другого рода) их стоит переписать.
+# Личность — шаблон с {memory_block} и {now}, как PERSONA (str.format:
+# литеральные фигурные скобки пишутся как {{ }}). У всех ботов общие
+# пул HTTP-соединений, база и планировщик. Таблицы не меняются: chat_id чата
+# бота k хранится как ±(k·2^53 + |id|) — у бота 0 он совпадает с телеграмным
+# (старая база подходит как есть), знак сохраняется (группы по-прежнему < 0),
+# а id бота нельзя менять, пока у него есть данные.
+
+BOT_ID_SHIFT = 53                # |id| пользователя в Telegram — до 52 бит
+MAX_BOTS = 1 << (63 - BOT_ID_SHIFT)
+
+PROACTIVE_LIMITS = {"cap_per_day": PROACTIVE_CAP_PER_DAY, "min_silence_h": PROACTIVE_MIN_SILENCE_H,
+                    "max_silence_d": PROACTIVE_MAX_SILENCE_D, "gap_h": PROACTIVE_GAP_H,
+                    "prob": PROACTIVE_PROB}
+
+
+class Bot:
+    def __init__(self, bot_id, token, secret, name="Аннет", persona=PERSONA, model=MODEL,
+                 model_light=MODEL_LIGHT, proactive=PROACTIVE_ENABLED, names=None, lines=None,
+                 prompts=None, proactive_limits=None):
+        if not 0 <= bot_id < MAX_BOTS:
+            raise ValueError(f"bot id {bot_id}: нужен 0..{MAX_BOTS - 1}")
+        self.id, self.token, self.secret, self.name = bot_id, token, secret, name
+        self.head, self.tail = _split_persona(bot_id, name, persona)
+        light = model_light or model
+        self.models = {"reply": model, "notes": light, "summary": light, "proactive": light}
+        self.proactive = proactive
+        self.limits = _override(bot_id, "proactive_limits", PROACTIVE_LIMITS, proactive_limits)
+        self.names = tuple(names if names is not None else BOT_NAMES)
+        self.lines = _override(bot_id, "lines", BOT_LINES, lines)
+        self.prompts = _override(bot_id, "prompts", BOT_PROMPTS, prompts)
+        for key in prompts or ():
+            _check_template(bot_id, f"prompts.{key}", self.prompts[key], PROMPT_FIELDS[key])
+        self.username = ""
+        self.meta_key = "bot_username" if bot_id == 0 else f"bot_username:{bot_id}"
+
+    def key(self, tg_id):
+        """Телеграмный id (чата или апдейта) -> ключ в общих таблицах."""
+        base = self.id << BOT_ID_SHIFT
+        return base + tg_id if tg_id >= 0 else -(base - tg_id)
+
+
+def _override(bot_id, what, defaults, extra):
+    unknown = set(extra or ()) - set(defaults)
+    if unknown:
+        raise ValueError(f"бот {bot_id}: неизвестные ключи {what}: {', '.join(sorted(unknown))}")
+    return {**defaults, **(extra or {})}
+
+
+def _check_template(bot_id, what, text, fields):
+    try:
+        text.format(**dict.fromkeys(fields, "x"))
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"бот {bot_id}: {what}: ошибка шаблона ({e!r}); допустимы "
+                         f"{', '.join('{' + f + '}' for f in fields)}, фигурные скобки — {{{{ }}}}") from None
+
+
+def _split_persona(bot_id, name, persona):
+    """Шаблон личности -> (неизменная голова, хвост с {now}). Проверяет его
+    сразу при загрузке: кривой шаблон иначе ронял бы каждый ответ бота.
+    Правила у головы и хвоста одни — str.format: литеральные скобки {{ }}."""
+    where = f"бот {bot_id} ({name}): личность"
+    if persona.count("{memory_block}") != 1:
+        raise ValueError(f"{where} должна содержать ровно один {{memory_block}}")
+    head, tail = persona.split("{memory_block}")
+    try:
+        head = head.format()   # голова кэшируется — подстановок в ней нет
+        tail.format(now="понедельник, 01.01.2024, 00:00")
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"{where}: ошибка шаблона ({e!r}); допустимы только "
+                         "{memory_block} и {now} (в хвосте), фигурные скобки — {{ }}") from None
+    return head, tail
+
+
+def split_key(key):
+    """Ключ чата -> (бот или None, если его убрали из конфига; телеграмный id)."""
+    bot_id, rest = divmod(abs(key), 1 << BOT_ID_SHIFT)
+    return BOTS.get(bot_id), rest if key >= 0 else -rest
+
+
+def bot_of(chat_id):
+    return split_key(chat_id)[0]
+
+
+def load_bots():
+    bots = [Bot(0, TG_TOKEN, WEBHOOK_SECRET)]
+    if BOTS_FILE:
+        with open(BOTS_FILE, encoding="utf-8") as f:
+            for cfg in json.load(f):
+                persona = cfg.get("persona")
+                if persona is None:
+                    with open(cfg["persona_file"], encoding="utf-8") as pf:
+                        persona = pf.read()
+                # своя основная модель без своей лёгкой — лёгкой служит она же
+                model = cfg.get("model", MODEL)
+                light = cfg.get("model_light", MODEL_LIGHT if model == MODEL else model)
+                bots.append(Bot(int(cfg["id"]), cfg["token"], cfg["secret"],
+                                name=cfg.get("name", "бот"), persona=persona,
+                                model=model, model_light=light,
+                                proactive=cfg.get("proactive", PROACTIVE_ENABLED),
+                                names=cfg.get("names", []),
+                                lines={"greeting": cfg.get("greeting", "привет."), **cfg.get("lines", {})},
+                                prompts=cfg.get("prompts"),
+                                proactive_limits=cfg.get("proactive_limits")))
+    if len({b.id for b in bots}) != len(bots) or len({b.secret for b in bots}) != len(bots):
+        raise ValueError("BOTS_FILE: id и secret ботов должны быть уникальны")
+    return bots
+
+
+BOTS = {b.id: b for b in load_bots()}
+DEFAULT_BOT = BOTS[0]
+BOTS_BY_SECRET = {b.secret: b for b in BOTS.values()}
+
 
 # ------------------------------------------------------------
 # БАЗА ДАННЫХ
 # ------------------------------------------------------------
 
-def db():
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    conn.execute("PRAGMA journal_mode=WAL")
+# Соединения живут долго и переиспользуются через пул: раньше каждый
+# хелпер заново открывал файл и слал PRAGMA под общим локом. WAL включается
+# один раз в init_db() (режим хранится в самом файле базы). Читатели в WAL
+# друг другу не мешают, поэтому _db_lock берут только пишущие хелперы.
+
+_db_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+
+
+def _db_connect():
+    conn = sqlite3.connect(DB_PATH, timeout=15, check_same_thread=False,
+                           cached_statements=DB_STMT_CACHE)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=15000")
     return conn
 
 
+@contextmanager
+def db():
+    """Берёт соединение из пула (или открывает новое) и коммитит на выходе.
+    Подготовленные выражения кэшируются в самом соединении."""
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _db_connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        if _db_pool.qsize() < DB_POOL_SIZE:
+            _db_pool.put(conn)
+        else:
+            conn.close()
+
+
 def init_db():
     with _db_lock, db() as c:
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")   # действует на новые базы
+        c.execute("PRAGMA journal_mode=WAL")
         c.execute("""CREATE TABLE IF NOT EXISTS messages(
             chat_id INTEGER, role TEXT, content TEXT, ts INTEGER)""")
         c.execute("CREATE INDEX IF NOT EXISTS idx_msg ON messages(chat_id, ts)")
         c.execute("""CREATE TABLE IF NOT EXISTS meta(
             key TEXT PRIMARY KEY, value TEXT)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS chats(
+            chat_id INTEGER PRIMARY KEY,
+            last_user_ts INTEGER NOT NULL DEFAULT 0,
+            last_proactive_ts INTEGER NOT NULL DEFAULT 0,
+            proactive INTEGER NOT NULL DEFAULT 1,
+            msgcount INTEGER NOT NULL DEFAULT 0,
+            notes TEXT NOT NULL DEFAULT '',
+            day TEXT NOT NULL DEFAULT '',
+            day_count INTEGER NOT NULL DEFAULT 0)""")
+        have = {r[1] for r in c.execute("PRAGMA table_info(chats)")}
+        for col, decl in CHAT_COLUMNS_ADDED:
+            if col not in have:
+                c.execute(f"ALTER TABLE chats ADD COLUMN {col} {decl}")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chats_proactive ON chats(proactive, last_user_ts)")
+        c.execute("""CREATE TABLE IF NOT EXISTS archive(
+            chat_id INTEGER, day TEXT, rows INTEGER, data BLOB,
+            PRIMARY KEY(chat_id, day))""")
+        c.execute("""CREATE TABLE IF NOT EXISTS jobs(
+            kind TEXT, chat_id INTEGER, due_ts INTEGER NOT NULL, tries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(kind, chat_id))""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs(due_ts)")
+        if isinstance(coord, SqliteCoord):
+            coord.init(c)
+        _migrate_meta_to_chats(c)
+        recall_init(c)
+
+
+def _migrate_meta_to_chats(c):
+    """Однократный перенос старых ключей вида `notes:{chat_id}` из meta в chats."""
+    if c.execute("SELECT value FROM meta WHERE key='schema'").fetchone():
+        return
+    chats = {}
+    rows = c.execute("""SELECT key, value FROM meta WHERE key LIKE 'notes:%'
+        OR key LIKE 'msgcount:%' OR key LIKE 'proactive:%' OR key LIKE 'last_user_ts:%'
+        OR key LIKE 'last_proactive_ts:%' OR key LIKE 'proactive_count:%'""").fetchall()
+    for key, value in rows:
+        name, _, rest = key.partition(":")
+        chat_id, _, day = rest.partition(":")
+        try:
+            row = chats.setdefault(int(chat_id), {})
+            if name == "notes":
+                row["notes"] = value or ""
+            elif name == "proactive":
+                row["proactive"] = 1 if value == "1" else 0
+            elif name == "proactive_count":
+                if day >= row.get("day", ""):  # нужен только последний день
+                    row["day"], row["day_count"] = day, int(value or 0)
+            else:
+                row[name] = int(value or 0)
+        except ValueError:
+            continue
+    for chat_id, row in chats.items():
+        _chat_upsert(c, chat_id, row)
+    c.executemany("DELETE FROM meta WHERE key=?", [(k,) for k, _ in rows])
+    c.execute("INSERT OR REPLACE INTO meta VALUES ('schema', '2')")
+    if chats:
+        log("migrated meta -> chats:", len(chats))
 
 
 def save_message(chat_id, role, content):
+    ingest_sync(chat_id)   # буфер чата — раньше, чтобы не нарушить порядок
     with _db_lock, db() as c:
         c.execute("INSERT INTO messages VALUES (?,?,?,?)",
                   (chat_id, role, content, int(time.time())))
 
 
 def get_history(chat_id, limit=HISTORY_LIMIT):
-    with _db_lock, db() as c:
+    ingest_sync(chat_id)
+    with db() as c:
         rows = c.execute(
             "SELECT role, content FROM messages WHERE chat_id=? ORDER BY ts DESC, rowid DESC LIMIT ?",
             (chat_id, limit)).fetchall()
     return [{"role": r, "content": t} for r, t in reversed(rows)]
 
 
+def estimate_tokens(text):
+    """Грубая офлайн-оценка: ~4 байта UTF-8 на токен (кириллица — 2 байта на
+    букву) плюс служебные токены на сообщение. Чуть завышает — это нам и нужно."""
+    return len(text.encode("utf-8")) // 4 + 4
+
+
+def clip_to_tokens(text, tokens):
+    raw = text.encode("utf-8")
+    if len(raw) <= tokens * 4:
+        return text
+    return raw[:tokens * 4].decode("utf-8", errors="ignore") + "…"
+
+
+def history_window(chat_id, budget=HISTORY_TOKEN_BUDGET, max_rows=HISTORY_MAX_ROWS):
+    """Самые свежие сообщения после уже пересказанной части, сколько влезает
+    в budget токенов (но не больше max_rows). Одно огромное сообщение
+    обрезается до половины бюджета. Возвращает (сообщения, rowid первого)."""
+    ingest_sync(chat_id)
+    after = chat_get(chat_id)["summary_rowid"]
+    with db() as c:
+        rows = c.execute(
+            "SELECT rowid, role, content FROM messages WHERE chat_id=? AND rowid>? "
+            "ORDER BY ts DESC, rowid DESC LIMIT ?", (chat_id, after, max_rows)).fetchall()
+    picked, used = [], 0
+    for rowid, role, content in rows:
+        content = clip_to_tokens(content, budget // 2)
+        cost = estimate_tokens(content)
+        if picked and used + cost > budget:
+            break
+        picked.append((rowid, role, content))
+        used += cost
+    picked.reverse()
+    first = picked[0][0] if picked else None
+    return [{"role": r, "content": t} for _, r, t in picked], first
+
+
+def history_for_prompt(chat_id, limit=None):
+    if HISTORY_TOKEN_BUDGET <= 0:
+        return get_history(chat_id, limit or HISTORY_LIMIT)
+    return history_window(chat_id, max_rows=limit or HISTORY_MAX_ROWS)[0]
+
+
 def clear_history(chat_id):
+    ingest_sync(chat_id)
     with _db_lock, db() as c:
+        if _recall_ok:
+            recall_forget(c, chat_id)   # пока текст ещё есть: индекс удаляет по нему
         c.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
+        c.execute("DELETE FROM archive WHERE chat_id=?", (chat_id,))
 
 
 def meta_get(key, default=None):
-    with _db_lock, db() as c:
+    with db() as c:
         row = c.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
     return row[0] if row else default
 
@@ -187,36 +668,810 @@ def meta_set(key, value):
         c.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (key, str(value)))
 
 
-def known_private_chats():
+# --- chats: одна типизированная строка на чат вместо россыпи meta-ключей ---
+
+CHAT_FIELDS = ("last_user_ts", "last_proactive_ts", "proactive",
+               "msgcount", "notes", "day", "day_count", "summary", "summary_rowid",
+               "group_store")
+CHAT_DEFAULTS = {"last_user_ts": 0, "last_proactive_ts": 0, "proactive": 1,
+                 "msgcount": 0, "notes": "", "day": "", "day_count": 0,
+                 "summary": "", "summary_rowid": 0, "group_store": -1}
+# колонки, появившиеся позже самой таблицы: init_db() докидывает их в старые базы
+CHAT_COLUMNS_ADDED = (("summary", "TEXT NOT NULL DEFAULT ''"),
+                      ("summary_rowid", "INTEGER NOT NULL DEFAULT 0"),
+                      ("group_store", "INTEGER NOT NULL DEFAULT -1"))   # -1 — как GROUP_STORE
+
+
+def _chat_upsert(c, chat_id, fields):
+    cols = [f for f in fields if f in CHAT_FIELDS]
+    if len(cols) != len(fields):
+        raise KeyError(f"unknown chat fields: {set(fields) - set(cols)}")
+    c.execute(
+        f"INSERT INTO chats(chat_id, {', '.join(cols)}) VALUES (?{', ?' * len(cols)}) "
+        f"ON CONFLICT(chat_id) DO UPDATE SET {', '.join(f'{f}=excluded.{f}' for f in cols)}",
+        (chat_id, *(fields[f] for f in cols)))
+
+
+# Строки chats читаются на каждый ответ (заметки для system_prompt), а
+# меняются редко — держим их в LRU-кэше. Все записи идут через chat_* хелперы
+# и обновляют кэш сразу после коммита (write-through).
+
+_chat_cache: OrderedDict = OrderedDict()   # chat_id -> (истекает, строка)
+_chat_cache_lock = threading.Lock()
+
+
+def _cache_put(chat_id, row):
+    with _chat_cache_lock:
+        _chat_cache[chat_id] = (time.monotonic() + CHAT_CACHE_TTL, row)
+        _chat_cache.move_to_end(chat_id)
+        while len(_chat_cache) > CHAT_CACHE_SIZE:
+            _chat_cache.popitem(last=False)
+
+
+def _cache_patch(chat_id, fields):
+    with _chat_cache_lock:
+        hit = _chat_cache.get(chat_id)
+        if hit:
+            hit[1].update(fields)
+
+
+def chat_cache_invalidate(chat_id):
+    with _chat_cache_lock:
+        _chat_cache.pop(chat_id, None)
+
+
+def chat_get(chat_id):
+    with _chat_cache_lock:
+        hit = _chat_cache.get(chat_id)
+        if hit and hit[0] > time.monotonic():
+            _chat_cache.move_to_end(chat_id)
+            return dict(hit[1])
+    with db() as c:
+        row = c.execute(f"SELECT {', '.join(CHAT_FIELDS)} FROM chats WHERE chat_id=?",
+                        (chat_id,)).fetchone()
+    row = dict(zip(CHAT_FIELDS, row)) if row else dict(CHAT_DEFAULTS)
+    _cache_put(chat_id, row)
+    return dict(row)
+
+
+def chat_set(chat_id, **fields):
+    with _db_lock, db() as c:
+        _chat_upsert(c, chat_id, fields)
+    _cache_patch(chat_id, fields)
+
+
+def chat_bump_msgcount(chat_id):
+    """Атомарно увеличивает счётчик сообщений чата и возвращает новое значение."""
+    with _db_lock, db() as c:
+        c.execute("""INSERT INTO chats(chat_id, msgcount) VALUES (?, 1)
+            ON CONFLICT(chat_id) DO UPDATE SET msgcount = msgcount + 1""", (chat_id,))
+        cnt = c.execute("SELECT msgcount FROM chats WHERE chat_id=?", (chat_id,)).fetchone()[0]
+    _cache_patch(chat_id, {"msgcount": cnt})
+    return cnt
+
+
+def chat_mark_proactive(chat_id, ts, today):
     with _db_lock, db() as c:
+        c.execute("""UPDATE chats SET last_proactive_ts=?,
+            day_count = CASE WHEN day=? THEN day_count + 1 ELSE 1 END, day=?
+            WHERE chat_id=?""", (ts, today, today, chat_id))
+    chat_cache_invalidate(chat_id)
+
+
+def proactive_chats(since_ts):
+    """Личные чаты с включённой проактивностью, писавшие не раньше since_ts, —
+    один запрос по индексу (proactive, last_user_ts)."""
+    with db() as c:
         rows = c.execute(
-            "SELECT DISTINCT chat_id FROM messages WHERE chat_id > 0").fetchall()
-    return [r[0] for r in rows]
+            f"""SELECT chat_id, {', '.join(CHAT_FIELDS)} FROM chats
+                WHERE proactive=1 AND last_user_ts >= ? AND chat_id > 0""",
+            (since_ts,)).fetchall()
+    return [(r[0], dict(zip(CHAT_FIELDS, r[1:]))) for r in rows]
 
 
 # ------------------------------------------------------------
-# TELEGRAM API
+# КООРДИНАЦИЯ ВОРКЕРОВ
+# ------------------------------------------------------------
+# Локи чатов, счётчики сообщений и дедупликация апдейтов раньше жили в
+# памяти одного процесса — со вторым воркером gunicorn всё это ломалось.
+# Теперь за них отвечает бэкенд с простым интерфейсом:
+#   acquire(name, ttl) / release(name) — аренда с истечением (lease),
+#   bump_many(items, c) / counter(id)  — счётчики входящих, ждущих ответа
+#                                        (c — транзакция пачки из ingest_flush),
+#   seen(update_id)                    — True, если апдейт уже встречался,
+#   mark_seen_many(ids, c)             — запомнить новые id (пачкой из ingest_flush).
+# SqliteCoord работает через общую базу (несколько воркеров одного узла или
+# сетевой диск), MemoryCoord — локальная замена Redis для одного процесса;
+# реализацию на Redis можно подставить с тем же набором методов.
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{random.randrange(1 << 30):x}"
+SEEN_RING_SIZE = 2000
+
+
+class SeenRing:
+    """Последние N id: множество для проверки за O(1) + кольцо для вытеснения."""
+
+    def __init__(self, size=SEEN_RING_SIZE):
+        self._set = set()
+        self._ring = deque()
+        self._size = size
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Добавляет key; возвращает True, если он уже был."""
+        with self._lock:
+            if key in self._set:
+                return True
+            self._set.add(key)
+            self._ring.append(key)
+            if len(self._ring) > self._size:
+                self._set.discard(self._ring.popleft())
+            return False
+
+
+class MemoryCoord:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._counters = {}
+        self._seen = SeenRing()
+
+    def acquire(self, name, ttl):
+        now = time.time()
+        with self._lock:
+            owner, expires = self._leases.get(name, (None, 0))
+            if owner not in (None, NODE_ID) and expires > now:
+                return False
+            self._leases[name] = (NODE_ID, now + ttl)
+            return True
+
+    def release(self, name):
+        with self._lock:
+            if self._leases.get(name, (None,))[0] == NODE_ID:
+                del self._leases[name]
+
+    def bump_many(self, items, c=None):
+        with self._lock:
+            for chat_id, n in items:
+                self._counters[chat_id] = self._counters.get(chat_id, 0) + n
+
+    def counter(self, chat_id):
+        with self._lock:
+            return self._counters.get(chat_id, 0)
+
+    def seen(self, update_id):
+        return self._seen.add(update_id)
+
+    def mark_seen_many(self, ids, c=None):
+        pass  # кольцо уже запомнило их в seen()
+
+
+class SqliteCoord:
+    def __init__(self):
+        self._seen = SeenRing()     # локальный фильтр перед походом в базу
+        self._inserts = 0
+
+    def init(self, c):
+        c.execute("""CREATE TABLE IF NOT EXISTS leases(
+            name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS counters(
+            chat_id INTEGER PRIMARY KEY, n INTEGER NOT NULL)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS updates(
+            update_id INTEGER PRIMARY KEY, ts INTEGER NOT NULL)""")
+
+    def acquire(self, name, ttl):
+        now = time.time()
+        with _db_lock, db() as c:
+            cur = c.execute(
+                """INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE
+                   SET owner=excluded.owner, expires=excluded.expires
+                   WHERE leases.owner=excluded.owner OR leases.expires < ?""",
+                (name, NODE_ID, now + ttl, now))
+            return cur.rowcount == 1
+
+    def release(self, name):
+        with _db_lock, db() as c:
+            c.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, NODE_ID))
+
+    def bump_many(self, items, c):
+        c.executemany("""INSERT INTO counters VALUES (?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET n = n + excluded.n""", items)
+
+    def counter(self, chat_id):
+        with db() as c:
+            row = c.execute("SELECT n FROM counters WHERE chat_id=?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def seen(self, update_id):
+        if self._seen.add(update_id):
+            return True
+        with db() as c:
+            if c.execute("SELECT 1 FROM updates WHERE update_id=?", (update_id,)).fetchone():
+                return True
+        # сама запись уедет пачкой: повторная доставка от Telegram приходит
+        # через секунды, а пачка сбрасывается за доли секунды
+        ingest_update_id(update_id)
+        return False
+
+    def mark_seen_many(self, ids, c):
+        now = int(time.time())
+        c.executemany("INSERT OR IGNORE INTO updates VALUES (?, ?)", [(i, now) for i in ids])
+        self._inserts += len(ids)
+        if self._inserts >= 1000:
+            self._inserts = 0
+            c.execute("DELETE FROM updates WHERE ts < ?", (now - 86400,))
+
+
+coord = SqliteCoord() if COORD_BACKEND == "sqlite" else MemoryCoord()
+
+
+def get_counter(chat_id):
+    with _ingest_lock:
+        pending = _ingest_bumps.get(chat_id, 0)
+    return coord.counter(chat_id) + pending
+
+
+# ------------------------------------------------------------
+# ПРИЁМ СООБЩЕНИЙ: запись пачками (write-behind)
+# ------------------------------------------------------------
+# Вебхук больше не пишет в базу сам: входящее сообщение, last_user_ts и
+# счётчик копятся в буфере и раз в INGEST_FLUSH_MS (или по INGEST_MAX_ROWS)
+# уходят одной транзакцией. В шумной группе это одна запись на пачку вместо
+# трёх на каждое сообщение. Всё, что читает историю чата, сначала вызывает
+# ingest_sync(chat_id) — так свои же записи видны сразу.
+
+_ingest_lock = threading.Lock()
+_ingest_msgs: list = []      # (chat_id, role, content, ts)
+_ingest_last: dict = {}      # chat_id -> last_user_ts
+_ingest_bumps: dict = {}     # chat_id -> сколько прибавить к счётчику
+_ingest_updates: list = []   # update_id для дедупликации между воркерами
+_ingest_stats = {"messages": 0, "flushes": 0}
+
+
+def ingest_user_message(chat_id, content, asks=True):
+    """asks=False — сообщение только для контекста (в группе не к боту):
+    счётчик не трогаем, иначе чужая болтовня перезапускала бы ответ."""
+    now = int(time.time())
+    with _ingest_lock:
+        _ingest_msgs.append((chat_id, "user", content, now))
+        _ingest_last[chat_id] = now
+        if asks:
+            _ingest_bumps[chat_id] = _ingest_bumps.get(chat_id, 0) + 1
+        full = len(_ingest_msgs) >= INGEST_MAX_ROWS
+    _cache_patch(chat_id, {"last_user_ts": now})
+    if full or INGEST_FLUSH_MS <= 0:
+        ingest_flush()
+
+
+def ingest_update_id(update_id):
+    with _ingest_lock:
+        _ingest_updates.append(update_id)
+
+
+def ingest_flush():
+    global _ingest_msgs, _ingest_last, _ingest_bumps, _ingest_updates
+    # буфер меняем на пустой, только когда запись гарантированно пройдёт
+    # следующей: держим _db_lock, чтобы пачки не обгоняли друг друга
+    with _db_lock:
+        with _ingest_lock:
+            msgs, last, bumps, upds = _ingest_msgs, _ingest_last, _ingest_bumps, _ingest_updates
+            if not msgs and not upds:
+                return
+            _ingest_msgs, _ingest_last, _ingest_bumps, _ingest_updates = [], {}, {}, []
+        try:
+            with db() as c:
+                coord.mark_seen_many(upds, c)
+                c.executemany("INSERT INTO messages VALUES (?,?,?,?)", msgs)
+                c.executemany("""INSERT INTO chats(chat_id, last_user_ts) VALUES (?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET last_user_ts=excluded.last_user_ts""",
+                              list(last.items()))
+                coord.bump_many(list(bumps.items()), c)
+        except Exception:
+            # транзакция откатилась (занятая база, кончился диск) — возвращаем
+            # пачку в начало буфера, пока держим _db_lock, и пробуем в следующий раз
+            with _ingest_lock:
+                _ingest_msgs[:0] = msgs
+                _ingest_updates[:0] = upds
+                for chat_id, ts in last.items():
+                    _ingest_last.setdefault(chat_id, ts)
+                for chat_id, n in bumps.items():
+                    _ingest_bumps[chat_id] = _ingest_bumps.get(chat_id, 0) + n
+            raise
+    for chat_id, ts in last.items():
+        _cache_patch(chat_id, {"last_user_ts": ts})
+    _ingest_stats["messages"] += len(msgs)
+    _ingest_stats["flushes"] += 1
+
+
+def ingest_sync(chat_id):
+    """Read-your-writes: если у чата есть несброшенные сообщения — сбросить."""
+    with _ingest_lock:
+        pending = chat_id in _ingest_last
+    if pending:
+        ingest_flush()
+
+
+async def ingest_loop():
+    while True:
+        await asyncio.sleep(max(INGEST_FLUSH_MS, 50) / 1000)
+        try:
+            ingest_flush()
+        except Exception as e:
+            log("ingest flush error:", repr(e))
+
+
+atexit.register(ingest_flush)
+
+
 # ------------------------------------------------------------
+# АРХИВ И УПЛОТНЕНИЕ
+# ------------------------------------------------------------
+# messages раньше только рос. Фоновая задача оставляет в нём горячий хвост
+# каждого чата (HOT_TAIL_ROWS и всё, что ещё не вошло в пересказ), а более
+# старое упаковывает zlib'ом в archive — одна строка на чат-день, rowid
+# сообщений сохраняются — и возвращает освободившиеся страницы через
+# incremental vacuum.
+
+def _pack(rows):
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"), 6)
+
+
+def _unpack(blob):
+    """Записи [role, content, ts, rowid]; у архивов до индекса воспоминаний
+    rowid нет или он None."""
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def _day(ts):
+    return datetime.fromtimestamp(ts, TZ).strftime("%Y-%m-%d")
+
+
+def compact_chat(chat_id, keep=HOT_TAIL_ROWS):
+    """Переносит в архив сообщения чата старше горячего хвоста; возвращает их число.
+    Читает и сжимает без _db_lock (в WAL читатели никому не мешают), под локом —
+    только короткая запись. Уплотнение идёт в одном воркере, так что архив чата
+    меж ними никто не меняет; /reset посреди прохода ловим по числу строк."""
+    row = chat_get(chat_id)
+    with db() as c:
+        edge = c.execute(
+            "SELECT rowid FROM messages WHERE chat_id=? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (chat_id, keep)).fetchone()
+        if not edge:
+            return 0
+        limit = edge[0]
+        if HISTORY_TOKEN_BUDGET > 0:
+            limit = min(limit, row["summary_rowid"])   # непересказанное не трогаем
+        old = c.execute(
+            "SELECT rowid, role, content, ts FROM messages WHERE chat_id=? AND rowid<=? ORDER BY rowid",
+            (chat_id, limit)).fetchall()
+        if not old:
+            return 0
+        by_day: dict = {}
+        for rowid, role, content, ts in old:
+            by_day.setdefault(_day(ts), []).append([role, content, ts, rowid])
+        packed = []
+        for day, rows in by_day.items():
+            have = c.execute("SELECT data FROM archive WHERE chat_id=? AND day=?",
+                             (chat_id, day)).fetchone()
+            if have:
+                rows = _unpack(have[0]) + rows
+            packed.append((chat_id, day, len(rows), _pack(rows)))
+    with _db_lock, db() as c:
+        left = c.execute("SELECT COUNT(*) FROM messages WHERE chat_id=? AND rowid<=?",
+                         (chat_id, limit)).fetchone()[0]
+        if left != len(old):
+            return 0   # историю стёрли, пока сжимали
+        c.executemany("INSERT OR REPLACE INTO archive VALUES (?,?,?,?)", packed)
+        c.execute("DELETE FROM messages WHERE chat_id=? AND rowid<=?", (chat_id, limit))
+    return len(old)
 
-def tg(method, payload):
+
+def _db_size(c):
+    page = c.execute("PRAGMA page_size").fetchone()[0]
+    return c.execute("PRAGMA page_count").fetchone()[0] * page
+
+
+def enable_incremental_vacuum():
+    """Старую базу без incremental vacuum переводим один раз полным VACUUM —
+    из startup() до запуска цикла бота: под живым трафиком он на всё время
+    прохода остановил бы все записи, а с ними ответы."""
+    with _db_lock, db() as c:
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        t0 = time.time()
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.commit()
+        c.execute("VACUUM")
+        log("db: incremental vacuum включён за", round(time.time() - t0, 2), "с")
+
+
+def reclaim_free_pages(chunk=COMPACT_VACUUM_PAGES):
+    """Отдаёт свободные страницы файлу кусками по chunk: лок держится недолго.
+    Через executescript — execute() модуля sqlite3 освобождает лишь страницу
+    за вызов, потому что не дочитывает PRAGMA до конца."""
+    while True:
+        with _db_lock, db() as c:
+            if not c.execute("PRAGMA freelist_count").fetchone()[0]:
+                return
+            c.executescript(f"PRAGMA incremental_vacuum({int(chunk)});")
+
+
+def compact_db():
+    """Один проход уплотнения по всем чатам с длинной историей."""
+    t0 = time.time()
+    with db() as c:
+        before = _db_size(c)
+        chats = [r[0] for r in c.execute(
+            "SELECT chat_id FROM messages GROUP BY chat_id HAVING COUNT(*) > ?", (HOT_TAIL_ROWS,))]
+    moved = 0
+    for chat_id in chats:
+        try:
+            moved += compact_chat(chat_id)
+        except Exception as e:
+            log("compact error chat", chat_id, repr(e))
+    with db() as c:
+        vacuum_ok = c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if vacuum_ok:
+        reclaim_free_pages()
+    with db() as c:
+        after = _db_size(c)
+    stats = {"chats": len(chats), "archived": moved, "reclaimed_bytes": before - after,
+             "db_bytes": after, "sec": round(time.time() - t0, 2)}
+    log("compaction:", stats)
+    return stats
+
+
+async def compaction_loop():
+    while True:
+        await asyncio.sleep(COMPACT_EVERY_SEC)
+        try:
+            if coord.acquire("compaction", COMPACT_EVERY_SEC / 2):
+                await asyncio.to_thread(compact_db)
+        except Exception as e:
+            log("compaction error:", repr(e))
+
+
+# ------------------------------------------------------------
+# ВОСПОМИНАНИЯ: полнотекстовый поиск по старой переписке
+# ------------------------------------------------------------
+# В промпт попадают только заметки, пересказ и свежее окно истории. Всё, что
+# человек рассказывал раньше, найдётся через FTS5-индекс recall (BM25 из
+# коробки SQLite). Индекс contentless: сам текст не хранит, только токены
+# под rowid сообщения, а recall_refs помнит чат и время. Текст найденного
+# берётся из messages или, если сообщение уже уплотнено, из архива того дня —
+# так уплотнение индекс не трогает и архивное остаётся находимым, а база не
+# держит вторую несжатую копию переписки. Триггер на messages индексирует
+# каждую реплику человека. Перед ответом его последние реплики превращаются
+# в запрос, и несколько лучших совпадений старше окна уходят в изменчивую
+# часть промпта.
+
+_recall_ok = False
+_WORD = re.compile(r"\w{4,}")
+
+
+def _recall_chat(chat_id):
+    """Чат как отдельный токен индекса: поиск сразу сужается до одного чата."""
+    return f"c{chat_id}".replace("-", "m")
+
+
+def recall_init(c):
+    global _recall_ok
+    have = c.execute("SELECT sql FROM sqlite_master WHERE name='recall'").fetchone()
+    if RECALL_TOP_K <= 0:
+        # выключено — убираем и триггер: иначе индекс рос бы дальше, а /reset
+        # его уже не чистил бы. Включат снова — соберётся заново
+        _recall_drop(c)
+        return
+    if have and "content=''" not in have[0]:
+        _recall_upgrade(c)
+        have = None
     try:
-        r = requests.post(f"{TG_API}/{method}", json=payload, timeout=30)
-        return r.json()
-    except Exception as e:
-        log("tg error:", method, repr(e))
-        return {}
+        c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS recall USING fts5(
+            chat, content, content='', tokenize='unicode61 remove_diacritics 2')""")
+    except sqlite3.OperationalError as e:
+        log("recall disabled (no FTS5):", repr(e))
+        return
+    c.execute("""CREATE TABLE IF NOT EXISTS recall_refs(
+        mid INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, ts INTEGER NOT NULL)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_recall_refs_chat ON recall_refs(chat_id)")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS recall_ai AFTER INSERT ON messages
+        WHEN new.role = 'user' BEGIN
+            INSERT INTO recall(rowid, chat, content)
+            VALUES (new.rowid, 'c' || replace(new.chat_id, '-', 'm'), new.content);
+            INSERT OR REPLACE INTO recall_refs VALUES (new.rowid, new.chat_id, new.ts);
+        END""")
+    if not have:
+        n = _recall_fill(c)
+        if n:
+            log("recall index built:", n)
+    _recall_ok = True
+
+
+def _recall_drop(c):
+    c.execute("DROP TRIGGER IF EXISTS recall_ai")
+    c.execute("DROP TABLE IF EXISTS recall")
+    c.execute("DROP TABLE IF EXISTS recall_refs")
+
+
+def _recall_fill(c):
+    """Индексирует все реплики человека: горячие и из архива (где есть rowid)."""
+    c.execute("""INSERT INTO recall(rowid, chat, content)
+        SELECT rowid, 'c' || replace(chat_id, '-', 'm'), content FROM messages WHERE role='user'""")
+    c.execute("""INSERT OR REPLACE INTO recall_refs
+        SELECT rowid, chat_id, ts FROM messages WHERE role='user'""")
+    n = c.execute("SELECT changes()").fetchone()[0]
+    for chat_id, blob in c.execute("SELECT chat_id, data FROM archive").fetchall():
+        rows = [e for e in _unpack(blob) if e[0] == "user" and len(e) > 3 and e[3] is not None]
+        c.executemany("INSERT INTO recall(rowid, chat, content) VALUES (?, ?, ?)",
+                      [(e[3], _recall_chat(chat_id), e[1]) for e in rows])
+        c.executemany("INSERT OR REPLACE INTO recall_refs VALUES (?, ?, ?)",
+                      [(e[3], chat_id, e[2]) for e in rows])
+        n += len(rows)
+    return n
+
+
+def _recall_upgrade(c):
+    """Прежний индекс хранил полный текст, а архив — записи без rowid. Пока
+    старый индекс жив, проставляем по нему rowid в архивные реплики (по чату,
+    времени и тексту), потом сносим его; новый соберёт _recall_fill."""
+    fixed = 0
+    for chat_id in [r[0] for r in c.execute("SELECT DISTINCT chat_id FROM archive")]:
+        mids = {(ts, content): mid for content, mid, ts in c.execute(
+            "SELECT content, mid, ts FROM recall WHERE recall MATCH ?", (f"chat:{_recall_chat(chat_id)}",))}
+        for day, blob in c.execute("SELECT day, data FROM archive WHERE chat_id=?", (chat_id,)).fetchall():
+            rows = _unpack(blob)
+            for e in rows:
+                if len(e) == 3:
+                    e.append(mids.get((e[2], e[1])) if e[0] == "user" else None)
+                    fixed += e[3] is not None
+            c.execute("UPDATE archive SET data=? WHERE chat_id=? AND day=?", (_pack(rows), chat_id, day))
+    _recall_drop(c)
+    log("recall index: переход на contentless, архивных реплик с rowid:", fixed)
+
+
+def recall_forget(c, chat_id):
+    """Убирает чат из индекса (до удаления самих сообщений). Contentless FTS5
+    удаляет только по исходному тексту — берём его из messages и архива."""
+    mids = {r[0] for r in c.execute("SELECT mid FROM recall_refs WHERE chat_id=?", (chat_id,))}
+    rows = c.execute("SELECT rowid, content FROM messages WHERE chat_id=? AND role='user'",
+                     (chat_id,)).fetchall()
+    for (blob,) in c.execute("SELECT data FROM archive WHERE chat_id=?", (chat_id,)).fetchall():
+        rows += [(e[3], e[1]) for e in _unpack(blob) if e[0] == "user" and len(e) > 3]
+    tok = _recall_chat(chat_id)
+    c.executemany("INSERT INTO recall(recall, rowid, chat, content) VALUES('delete', ?, ?, ?)",
+                  [(mid, tok, content) for mid, content in rows if mid in mids])
+    c.execute("DELETE FROM recall_refs WHERE chat_id=?", (chat_id,))
+
+
+def _recall_texts(c, chat_id, mids):
+    """rowid -> текст: из горячих сообщений, остальное — из архива нужных дней."""
+    out = {}
+    marks = ",".join("?" * len(mids))
+    for mid, content in c.execute(f"SELECT rowid, content FROM messages WHERE chat_id=? "
+                                  f"AND rowid IN ({marks})", (chat_id, *mids)):
+        out[mid] = content
+    days = {_day(ts) for mid, ts in mids.items() if mid not in out}
+    for day in days:
+        blob = c.execute("SELECT data FROM archive WHERE chat_id=? AND day=?", (chat_id, day)).fetchone()
+        for e in _unpack(blob[0]) if blob else ():
+            if len(e) > 3 and e[3] in mids:
+                out[e[3]] = e[1]
+    return out
+
+
+def _recall_query(text):
+    """Запрос по словам от 4 букв; окончание срезается и ставится *,
+    чтобы «собаку» находила «собака» (вместо стемминга для русского)."""
+    terms = []
+    for w in _WORD.findall(text.lower()):
+        stem = w[:max(4, len(w) - 2)]
+        if stem not in terms:
+            terms.append(stem)
+    return " OR ".join(f'"{t}"*' for t in terms[:16])
+
+
+def recall_block(chat_id, history):
+    """Несколько старых реплик человека, похожих на его последние сообщения
+    и не попавших в окно истории; готовый блок для промпта или ""."""
+    if not _recall_ok or not history:
+        return ""
+    said = [m["content"] for m in history if m["role"] == "user"][-2:]
+    query = _recall_query(" ".join(said))
+    if not query:
+        return ""
+    with db() as c:
+        first = c.execute("SELECT MIN(rowid) FROM (SELECT rowid FROM messages WHERE chat_id=? "
+                          "ORDER BY rowid DESC LIMIT ?)", (chat_id, len(history))).fetchone()[0] or 0
+        hits = c.execute(
+            "SELECT recall.rowid, ts, -bm25(recall) AS score FROM recall "
+            "JOIN recall_refs ON recall_refs.mid = recall.rowid "
+            "WHERE recall MATCH ? AND recall.rowid < ? ORDER BY bm25(recall) LIMIT ?",
+            (f"chat:{_recall_chat(chat_id)} AND content:({query})", first, RECALL_TOP_K)).fetchall()
+        hits = [(mid, ts) for mid, ts, score in hits if score >= RECALL_MIN_SCORE]
+        texts = _recall_texts(c, chat_id, dict(hits)) if hits else {}
+    snippets = [f"— {datetime.fromtimestamp(ts, TZ).strftime('%d.%m.%Y')}: {clip_to_tokens(texts[mid], 80)}"
+                for mid, ts in hits if mid in texts]
+    if snippets:
+        inc("annet_recall_hits_total", len(snippets))
+    return bot_of(chat_id).prompts["recall"].format(snippets="\n".join(snippets)) if snippets else ""
+
+
+# ------------------------------------------------------------
+# РАНТАЙМ: один asyncio-цикл на процесс
+# ------------------------------------------------------------
+# Вся сетевая работа (Telegram, OpenRouter, паузы «набора») — корутины на
+# одном цикле в фоновом потоке. Тысяча «печатающих» чатов — это тысяча
+# корутин, а не тысяча спящих потоков. Вход — либо Flask (gunicorn app:app),
+# либо ASGI (uvicorn app:asgi_app); оба просто передают апдейт в цикл.
+# SQLite остаётся синхронным: запросы короткие и идут прямо из корутин.
+
+_loop = asyncio.new_event_loop()
+_loop_thread = None
+_tasks: set = set()          # держим ссылки, чтобы задачи не собрал GC
+_clients: dict = {}          # host -> httpx.AsyncClient (keep-alive пул)
+
+
+def start_runtime():
+    global _loop_thread
+    if _loop_thread is None:
+        _loop_thread = threading.Thread(target=_loop.run_forever, name="annet-loop", daemon=True)
+        _loop_thread.start()
+        for _ in range(DIALOG_WORKERS):
+            spawn(_dispatch_worker())
+        spawn(ingest_loop())
+        spawn(memory_loop())
+
+
+def spawn(coro):
+    """Запускает корутину в цикле бота из любого потока (fire-and-forget)."""
+    def _start():
+        task = _loop.create_task(coro)
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    _loop.call_soon_threadsafe(_start)
+
+
+def run_sync(coro, timeout=None):
+    """Выполняет корутину в цикле бота и ждёт результат (для синхронного кода)."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result(timeout)
+
+
+def http(base_url, timeout):
+    """Общий клиент с пулом keep-alive соединений на хост: TCP+TLS один раз."""
+    client = _clients.get(base_url)
+    if client is None:
+        client = httpx.AsyncClient(
+            base_url=base_url, timeout=timeout,
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE,
+                                max_keepalive_connections=HTTP_POOL_SIZE,
+                                keepalive_expiry=60))
+        _clients[base_url] = client
+    return client
+
+
+# ------------------------------------------------------------
+# TELEGRAM API
+# ------------------------------------------------------------
+
+# Исходящие идут через token bucket'ы: общий на бота и свой на каждый чат.
+# Токен резервируется сразу (счёт уходит в минус), поэтому ждущие встают
+# в очередь по порядку. На 429 ждём retry_after и повторяем, а корзину чата
+# штрафуем, чтобы остальные отправки туда тоже подождали. «Печатает» живёт
+# ~5 секунд и гаснет с первым сообщением, так что повторный sendChatAction
+# в это окно не шлём. Всё это трогается только из цикла бота — без локов.
+
+_buckets: dict = {}          # ключ -> (токены, время пополнения)
+_typing_until: dict = {}     # chat_id -> до какого времени ещё висит «печатает»
+_tg_stats = {"sent": 0, "failed": 0, "retries": 0, "rate_limited": 0,
+             "typing_skipped": 0, "waiting": 0, "latency_sum": 0.0, "latency_max": 0.0}
 
 
-def send_typing(chat_id):
-    tg("sendChatAction", {"chat_id": chat_id, "action": "typing"})
+def _bucket_delay(key, rate, burst=TG_BURST):
+    """Берёт токен из корзины и возвращает, сколько ждать права на отправку."""
+    now = time.monotonic()
+    tokens, ts = _buckets.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - ts) * rate) - 1
+    _buckets[key] = (tokens, now)
+    if len(_buckets) > 20000:
+        for k in [k for k, (_, t) in _buckets.items() if now - t > 60]:
+            del _buckets[k]
+    return 0.0 if tokens >= 0 else -tokens / rate
 
 
-def send_text(chat_id, text, reply_to=None):
+def _bucket_penalize(key, seconds, rate):
+    _buckets[key] = (-seconds * rate, time.monotonic())
+
+
+def _chat_rate(chat_id):
+    return TG_GROUP_RATE if isinstance(chat_id, int) and chat_id < 0 else TG_PRIVATE_RATE
+
+
+async def _rate_wait(chat_id, bot):
+    _tg_stats["waiting"] += 1
+    try:
+        if chat_id is not None:
+            await asyncio.sleep(_bucket_delay(("chat", chat_id), _chat_rate(chat_id)))
+        await asyncio.sleep(_bucket_delay(("global", bot.id), TG_GLOBAL_RATE, TG_GLOBAL_RATE))
+    finally:
+        _tg_stats["waiting"] -= 1
+
+
+async def tg(method, payload, bot=None):
+    """Вызов Bot API. Если в payload есть chat_id — это ключ чата: бот и
+    телеграмный id берутся из него; иначе бот задаётся явно (по умолчанию 0)."""
+    chat_id = payload.get("chat_id")
+    bot = bot or DEFAULT_BOT
+    if chat_id is not None:
+        bot, tg_chat = split_key(chat_id)
+        if bot is None:
+            log("tg: чат бота, которого нет в конфиге:", chat_id)
+            return {}
+        payload = dict(payload, chat_id=tg_chat)
+    typing = method == "sendChatAction"
+    if typing and _typing_until.get(chat_id, 0) > time.monotonic():
+        _tg_stats["typing_skipped"] += 1
+        return {}
+    t0 = time.monotonic()
+    if method.startswith("send"):
+        if typing:
+            await asyncio.sleep(_bucket_delay(("global", bot.id), TG_GLOBAL_RATE, TG_GLOBAL_RATE))
+        else:
+            await _rate_wait(chat_id, bot)
+    data = {}
+    for attempt in range(TG_RETRIES + 1):
+        if attempt:
+            _tg_stats["retries"] += 1
+        try:
+            # один клиент (и пул соединений) на всех ботов, токен — в пути
+            r = await http(TG_API_BASE, 30).post(f"/bot{bot.token}/{method}", json=payload)
+            data = r.json()
+        except Exception as e:
+            log("tg error:", method, repr(e))
+            await asyncio.sleep(1 + attempt)
+            continue
+        if r.status_code == 429:
+            _tg_stats["rate_limited"] += 1
+            retry_after = (data.get("parameters") or {}).get("retry_after", 1)
+            if typing:
+                return data  # «печатает» не стоит ожидания
+            log("tg 429:", method, chat_id, "retry after", retry_after)
+            if chat_id is not None:
+                _bucket_penalize(("chat", chat_id), retry_after, _chat_rate(chat_id))
+            await asyncio.sleep(retry_after)
+            continue
+        if r.status_code >= 500:
+            await asyncio.sleep(1 + attempt)
+            continue
+        if typing:
+            _typing_until[chat_id] = time.monotonic() + 4.5
+        elif chat_id is not None:
+            _typing_until.pop(chat_id, None)
+            if data.get("ok"):
+                _tg_stats["sent"] += 1
+                lat = time.monotonic() - t0
+                _tg_stats["latency_sum"] += lat
+                _tg_stats["latency_max"] = max(_tg_stats["latency_max"], lat)
+        return data
+    _tg_stats["failed"] += 1
+    log("tg gave up:", method, chat_id)
+    return data
+
+
+def tg_stats():
+    sent = _tg_stats["sent"]
+    return dict(_tg_stats, latency_avg=round(_tg_stats["latency_sum"] / sent, 3) if sent else 0.0)
+
+
+async def send_typing(chat_id):
+    await tg("sendChatAction", {"chat_id": chat_id, "action": "typing"})
+
+
+async def send_text(chat_id, text, reply_to=None):
     payload = {"chat_id": chat_id, "text": text}
     if reply_to:
         payload["reply_to_message_id"] = reply_to
         payload["allow_sending_without_reply"] = True
-    tg("sendMessage", payload)
+    await tg("sendMessage", payload)
 
 
 def split_reply(text):
@@ -235,18 +1490,79 @@ def split_reply(text):
     return parts
 
 
-def send_human(chat_id, text, reply_to=None):
-    """Отправка с эффектом набора, каждый кусок — отдельное сообщение."""
+_BUBBLE_SEP = re.compile(r"\|\|\||\n")
+
+
+def typing_delay(part):
+    return min(2.5, max(0.5, len(part) * 0.02)) + random.uniform(0, 0.4)
+
+
+async def send_human(chat_id, text, reply_to=None, first_sent=None):
+    """Отправка с эффектом набора, каждый кусок — отдельное сообщение.
+    first_sent (asyncio.Event) взводится прямо перед первым пузырём: до
+    этого момента отправку можно отменить без следа в чате."""
     parts = split_reply(text)
     first = True
     for part in parts:
-        send_typing(chat_id)
-        time.sleep(min(2.5, max(0.5, len(part) * 0.02)) + random.uniform(0, 0.4))
-        send_text(chat_id, part, reply_to if first else None)
+        await send_typing(chat_id)
+        with timed("typing_sleep"):
+            await asyncio.sleep(typing_delay(part))
+        if first and first_sent is not None:
+            first_sent.set()
+        await send_text(chat_id, part, reply_to if first else None)
         first = False
     save_message(chat_id, "assistant", " ".join(parts))
 
 
+async def send_human_stream(chat_id, deltas, reply_to=None, first_sent=None):
+    """То же, что send_human, но по потоку кусков текста от модели: каждый
+    пузырь уходит, как только дописан (по ||| или переносу строки). Время,
+    пока модель его генерировала, засчитывается в паузу «набора».
+    Бросает исключение, только если не успели отправить ни одного пузыря."""
+    parts, buf = [], ""
+    started = time.monotonic()
+
+    async def emit(part):
+        nonlocal started
+        if parts:
+            await send_typing(chat_id)
+        wait = typing_delay(part) - (time.monotonic() - started)
+        if wait > 0:
+            with timed("typing_sleep"):
+                await asyncio.sleep(wait)
+        if not parts and first_sent is not None:
+            first_sent.set()
+        await send_text(chat_id, part, reply_to if not parts else None)
+        parts.append(part)
+        started = time.monotonic()
+
+    await send_typing(chat_id)
+    try:
+        async for delta in deltas:
+            buf += delta
+            # после 3 пузырей остальное копим и склеиваем в последний, как split_reply
+            while len(parts) < 3:
+                m = _BUBBLE_SEP.search(buf)
+                if not m:
+                    break
+                part, buf = buf[:m.start()].strip(), buf[m.end():]
+                if part:
+                    await emit(part)
+    except Exception as e:
+        if not parts:
+            raise
+        log("stream broke after", len(parts), "bubbles:", repr(e))
+        buf = ""
+    rest = " ".join(p.strip() for p in _BUBBLE_SEP.split(buf) if p.strip())
+    if rest:
+        await emit(rest)
+    if not parts:
+        inc("annet_llm_empty_total")
+        raise RuntimeError("openrouter: пустой ответ модели")
+    save_message(chat_id, "assistant", " ".join(parts))
+    return parts
+
+
 # ------------------------------------------------------------
 # LLM
 # ------------------------------------------------------------
@@ -255,101 +1571,539 @@ def now_msk():
     return datetime.now(TZ)
 
 
-def system_prompt(chat_id, tg_name=None):
+# Личность бота режется один раз (в Bot) на статичную голову и хвост со
+# временем; хвост рендерится раз в минуту, а не на каждый ответ.
+@lru_cache(maxsize=64)
+def _persona_tail(bot_id, minute):
     days = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-    dt = now_msk()
+    dt = datetime.fromtimestamp(minute * 60, TZ)
     now_str = f"{days[dt.weekday()]}, {dt.strftime('%d.%m.%Y, %H:%M')}"
+    return BOTS[bot_id].tail.format(now=now_str)
+
 
-    notes = meta_get(f"notes:{chat_id}", "") or ""
+def volatile_prompt(chat_id, tg_name=None, recall=""):
+    """Всё, что меняется от чата к чату и от минуты к минуте: заметки,
+    пересказ, всплывшие воспоминания и время."""
+    row = chat_get(chat_id)
+    prompts = bot_of(chat_id).prompts
+    notes = row["notes"]
     if not notes and tg_name:
-        notes = f"в телеграме он подписан как «{tg_name}» — но лучше спросить, как к нему обращаться."
-    mem = MEMORY_BLOCK.format(notes=notes) if notes else ""
-    return PERSONA.format(memory_block=mem, now=now_str)
+        notes = prompts["tg_name"].format(tg_name=tg_name)
+    mem = prompts["memory"].format(notes=notes) if notes else ""
+    if row["summary"] and HISTORY_TOKEN_BUDGET > 0:
+        mem += prompts["summary_block"].format(summary=row["summary"])
+    return mem + recall + _persona_tail(bot_of(chat_id).id, int(time.time() // 60))
 
 
-def llm(messages, max_tokens=LLM_MAX_TOKENS, retries=2):
+def system_prompt(chat_id, tg_name=None, recall=""):
+    return bot_of(chat_id).head + volatile_prompt(chat_id, tg_name, recall)
+
+
+def supports_cache_markers(model):
+    """Anthropic и Gemini кэшируют только по явным cache_control-меткам;
+    OpenAI, DeepSeek и прочие кэшируют одинаковый префикс сами."""
+    return model.startswith(("anthropic/", "google/gemini"))
+
+
+_llm_stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0,
+              "cache_write_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+
+
+def record_usage(usage):
+    """Копит поле usage из ответа OpenRouter: токены, попадания в кэш, цена."""
+    if not usage:
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    _llm_stats["calls"] += 1
+    _llm_stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    _llm_stats["completion_tokens"] += usage.get("completion_tokens") or 0
+    _llm_stats["cached_tokens"] += details.get("cached_tokens") or 0
+    _llm_stats["cache_write_tokens"] += details.get("cache_write_tokens") or 0
+    _llm_stats["cost"] += usage.get("cost") or 0.0
+    inc("annet_llm_tokens_total", usage.get("prompt_tokens") or 0, kind="prompt")
+    inc("annet_llm_tokens_total", usage.get("completion_tokens") or 0, kind="completion")
+    inc("annet_llm_tokens_total", details.get("cached_tokens") or 0, kind="cached")
+
+
+def llm_stats():
+    prompt = _llm_stats["prompt_tokens"]
+    return dict(_llm_stats, cache_hit_rate=round(_llm_stats["cached_tokens"] / prompt, 3) if prompt else 0.0)
+
+
+def _completion_text(status, data):
+    record_usage(data.get("usage"))
+    if status != 200 or "error" in data:
+        raise RuntimeError(f"openrouter {status}: {str(data.get('error'))[:200]}")
+    choices = data.get("choices") or []
+    content = ((choices[0].get("message") or {}).get("content") if choices else None)
+    if content and content.strip():
+        return content.strip()
+    inc("annet_llm_empty_total")
+    raise RuntimeError("openrouter: пустой ответ модели")
+
+
+class ModelHealth:
+    """Состояние одной модели: скользящие задержки (по ним считается порог
+    дубля) и предохранитель — после LLM_BREAKER_FAILS ошибок подряд модель
+    выбывает на LLM_BREAKER_COOLDOWN_SEC, потом получает одну пробную попытку."""
+
+    def __init__(self, model):
+        self.model = model
+        self.lat = {"full": deque(maxlen=200), "ttft": deque(maxlen=200)}
+        self.fails = 0
+        self.open_until = 0.0
+
+    def hedge_after(self, kind):
+        lat = self.lat[kind]
+        if len(lat) < 20:
+            return LLM_HEDGE_DEFAULT_SEC
+        p95 = sorted(lat)[int(len(lat) * 0.95)]
+        return max(LLM_HEDGE_MIN_SEC, p95)
+
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def ok(self, kind, sec):
+        self.lat[kind].append(sec)
+        self.fails = 0
+
+    def fail(self):
+        self.fails += 1
+        if self.fails >= LLM_BREAKER_FAILS:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN_SEC
+            inc("annet_llm_breaker_open_total", model=self.model)
+            log("llm breaker open:", self.model, "fails", self.fails)
+
+
+_model_health: dict = {}
+
+
+def model_health(model):
+    h = _model_health.get(model)
+    if h is None:
+        h = _model_health[model] = ModelHealth(model)
+    return h
+
+
+def model_chain(purpose="reply", bot=None):
+    """Модели по порядку для задачи: своя у бота (ответ человеку — основная,
+    фоновые задачи — лёгкая), потом запасные. Выбитые предохранителем
+    пропускаются; если выбиты все — пробуем все по порядку."""
+    primary = (bot or DEFAULT_BOT).models.get(purpose, MODEL)
+    chain = [primary] + [m for m in MODEL_FALLBACKS if m != primary]
+    return [m for m in chain if model_health(m).available()] or chain
+
+
+def breakers_open():
+    return sum(1 for h in list(_model_health.values()) if not h.available())
+
+
+async def hedged(model, kind, make, timeout, discard=None):
+    """Запускает make() и, если ответа нет дольше p95 этой модели, — такой же
+    дубль; берёт первый успешный, остальные отменяет. Ждёт не дольше timeout.
+    discard(result) закрывает результат проигравшего, если он тоже успел."""
+    health = model_health(model)
+    t0 = time.perf_counter()
+    hedge_at = t0 + health.hedge_after(kind) if LLM_HEDGE else None
+    deadline = t0 + timeout
+    pending = {asyncio.ensure_future(make())}
+    started, last_err = 1, None
+    try:
+        while pending:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            wake = min(deadline, hedge_at) if hedge_at and started == 1 else deadline
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, wake - now),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    last_err = task.exception()
+                elif winner is None:
+                    winner = task
+                elif discard:
+                    await discard(task.result())
+            if winner is not None:
+                health.ok(kind, time.perf_counter() - t0)
+                if started > 1:
+                    inc("annet_llm_hedge_wins_total", model=model)
+                return winner.result()
+            if not pending:
+                break                 # быстрая ошибка — дубль не поможет
+            if hedge_at and started == 1 and time.perf_counter() >= hedge_at:
+                inc("annet_llm_hedges_total", model=model)
+                pending.add(asyncio.ensure_future(make()))
+                started += 1
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    health.fail()
+    raise last_err or TimeoutError(f"{model}: нет ответа за {timeout:.0f}с")
+
+
+async def _complete(model, messages, max_tokens):
+    with timed("llm_request"):
+        r = await http(OPENROUTER_API, 90).post(
+            "/chat/completions",
+            headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}"},
+            json={"model": model, "max_tokens": max_tokens, "usage": {"include": True},
+                  "temperature": 0.85, "messages": messages},
+        )
+    return _completion_text(r.status_code, r.json())
+
+
+async def llm(messages, max_tokens=LLM_MAX_TOKENS, retries=2, purpose="reply", bot=None):
     """Запрос к OpenRouter с защитой от пустых ответов и ошибок.
-    Пробует до retries+1 раз, потом бросает исключение."""
+    Каждая попытка ограничена LLM_TIMEOUT_SEC и дублируется по p95;
+    следующая попытка идёт на следующую модель цепочки (или на ту же,
+    если запасных нет). После retries+1 попыток бросает исключение."""
     last_err = None
     for attempt in range(retries + 1):
+        chain = model_chain(purpose, bot)
+        model = chain[min(attempt, len(chain) - 1)]
+        if attempt and model != (bot or DEFAULT_BOT).models.get(purpose, MODEL):
+            inc("annet_llm_fallbacks_total", model=model)
         try:
-            r = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                         "Content-Type": "application/json"},
-                json={"model": MODEL, "max_tokens": max_tokens,
-                      "temperature": 0.85, "messages": messages},
-                timeout=90,
-            )
-            data = r.json()
-            if r.status_code != 200 or "error" in data:
-                raise RuntimeError(f"openrouter {r.status_code}: {str(data.get('error'))[:200]}")
+            return await hedged(model, "full", lambda: _complete(model, messages, max_tokens),
+                                LLM_TIMEOUT_SEC)
+        except Exception as e:
+            last_err = e
+            log(f"llm attempt {attempt + 1} ({model}) failed:", repr(e))
+            inc("annet_llm_retries_total")
+            if attempt < retries and len(chain) == 1:
+                with timed("llm_retry_sleep"):
+                    await asyncio.sleep(0.5 * (attempt + 1))
+    raise last_err
+
+
+async def _model_stream(model, messages, max_tokens):
+    """Потоковый запрос (SSE, stream: true) к одной модели: отдаёт куски
+    текста по мере генерации. Если сервер ответил обычным JSON — целиком."""
+    async with http(OPENROUTER_API, 90).stream(
+            "POST", "/chat/completions",
+            headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}"},
+            json={"model": model, "max_tokens": max_tokens, "stream": True,
+                  "usage": {"include": True},
+                  "temperature": 0.85, "messages": messages}) as r:
+        if "text/event-stream" not in r.headers.get("content-type", ""):
+            raw = await r.aread()
+            yield _completion_text(r.status_code, json.loads(raw or b"{}"))
+            return
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue  # пустые строки и комментарии-пинги ": OPENROUTER PROCESSING"
+            chunk = line[5:].strip()
+            if chunk == "[DONE]":
+                break
+            data = json.loads(chunk)
+            if "error" in data:
+                raise RuntimeError(f"openrouter stream: {str(data['error'])[:200]}")
+            record_usage(data.get("usage"))   # приходит в последнем чанке
             choices = data.get("choices") or []
-            content = ((choices[0].get("message") or {}).get("content") if choices else None)
-            if content and content.strip():
-                return content.strip()
-            raise RuntimeError("openrouter: пустой ответ модели")
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                yield delta
+
+
+async def _first_delta(model, messages, max_tokens):
+    gen = _model_stream(model, messages, max_tokens)
+    try:
+        return gen, await gen.__anext__()
+    except StopAsyncIteration:
+        inc("annet_llm_empty_total")
+        raise RuntimeError("openrouter: пустой ответ модели")
+    except BaseException:
+        await gen.aclose()
+        raise
+
+
+async def _close_stream(result):
+    await result[0].aclose()
+
+
+async def llm_stream(messages, max_tokens=LLM_MAX_TOKENS, purpose="reply", bot=None):
+    """Поток кусков ответа. До первого токена — не дольше LLM_TTFT_SEC на
+    модель (с дублем по p95), иначе следующая модель цепочки; после — не
+    больше LLM_STALL_SEC тишины между кусками."""
+    t0 = time.perf_counter()
+    last_err = None
+    for model in model_chain(purpose, bot):
+        try:
+            gen, first = await hedged(model, "ttft", lambda: _first_delta(model, messages, max_tokens),
+                                      LLM_TTFT_SEC, discard=_close_stream)
         except Exception as e:
             last_err = e
-            log(f"llm attempt {attempt + 1} failed:", repr(e))
-            time.sleep(1.5 * (attempt + 1))
+            log(f"llm stream ({model}) failed before first token:", repr(e))
+            continue
+        observe("annet_stage_seconds", time.perf_counter() - t0, stage="llm_first_token")
+        try:
+            yield first
+            while True:
+                try:
+                    delta = await asyncio.wait_for(gen.__anext__(), LLM_STALL_SEC)
+                except StopAsyncIteration:
+                    return
+                yield delta
+        except asyncio.TimeoutError:
+            model_health(model).fail()
+            raise TimeoutError(f"{model}: поток замолчал на {LLM_STALL_SEC}с")
+        finally:
+            await gen.aclose()
     raise last_err
 
 
-def llm_reply(chat_id, tg_name=None, extra_instruction=None, hist_limit=HISTORY_LIMIT):
-    messages = [{"role": "system", "content": system_prompt(chat_id, tg_name)}]
-    messages += get_history(chat_id, hist_limit)
+def reply_messages(chat_id, tg_name=None, extra_instruction=None, hist_limit=None, purpose="reply"):
+    bot = bot_of(chat_id)
+    model = bot.models.get(purpose, MODEL)
+    if PROMPT_CACHE:
+        # одинаковая для всех чатов бота личность первой (с меткой кэша),
+        # время и заметки — в самом конце, после истории
+        static = {"type": "text", "text": bot.head}
+        if supports_cache_markers(model):
+            static["cache_control"] = {"type": "ephemeral"}
+        messages = [{"role": "system", "content": [static]}]
+        with timed("history"):
+            history = history_for_prompt(chat_id, hist_limit)
+        with timed("recall"):
+            recall = recall_block(chat_id, history)
+        messages += history
+        with timed("system_prompt"):
+            messages.append({"role": "system", "content": volatile_prompt(chat_id, tg_name, recall)})
+    else:
+        with timed("history"):
+            history = history_for_prompt(chat_id, hist_limit)
+        with timed("recall"):
+            recall = recall_block(chat_id, history)
+        with timed("system_prompt"):
+            messages = [{"role": "system", "content": system_prompt(chat_id, tg_name, recall)}]
+        messages += history
     if extra_instruction:
         messages.append({"role": "user", "content": extra_instruction})
-    return llm(messages)
+    return messages
+
+
+async def llm_reply(chat_id, tg_name=None, extra_instruction=None, hist_limit=None, purpose="reply"):
+    return await llm(reply_messages(chat_id, tg_name, extra_instruction, hist_limit, purpose),
+                     purpose=purpose, bot=bot_of(chat_id))
+
+
+async def stream_reply(chat_id, tg_name=None, reply_to=None, retries=1, first_sent=None):
+    """Генерация и отправка одновременно: первый пузырь уходит, пока модель
+    ещё пишет остальные. Повторяет попытку, только если не ушло ничего
+    (запасные модели перебирает уже сам llm_stream)."""
+    messages = reply_messages(chat_id, tg_name)
+    last_err = None
+    for attempt in range(retries + 1):
+        stream = llm_stream(messages, bot=bot_of(chat_id))
+        try:
+            return await send_human_stream(chat_id, stream, reply_to, first_sent)
+        except Exception as e:
+            last_err = e
+            log(f"llm stream attempt {attempt + 1} failed:", repr(e))
+            inc("annet_llm_retries_total")
+            with timed("llm_retry_sleep"):
+                await asyncio.sleep(1.5 * (attempt + 1))
+        finally:
+            await stream.aclose()   # при отмене сразу рвёт запрос к OpenRouter
+    raise last_err
 
 
 # ------------------------------------------------------------
 # ДОЛГОВРЕМЕННАЯ ПАМЯТЬ
 # ------------------------------------------------------------
 
-def maybe_update_notes(chat_id):
-    cnt = int(meta_get(f"msgcount:{chat_id}", 0) or 0) + 1
-    meta_set(f"msgcount:{chat_id}", cnt)
-    if cnt % NOTES_EVERY_N != 0:
+def schedule_memory(chat_id):
+    """Зовётся после каждого ответа: только ставит задачи, LLM не ждёт."""
+    cnt = chat_bump_msgcount(chat_id)
+    if cnt % NOTES_EVERY_N == 0:
+        job_enqueue("notes", chat_id, MEMORY_DELAY_SEC)
+    if HISTORY_TOKEN_BUDGET > 0:
+        job_enqueue("summary", chat_id, MEMORY_DELAY_SEC)
+
+
+async def update_notes(chat_id):
+    old = chat_get(chat_id)["notes"] or "нет"
+    messages = history_for_prompt(chat_id, 40)
+    bot = bot_of(chat_id)
+    messages.append({"role": "user",
+                     "content": bot.prompts["notes"].format(name=bot.name, old_notes=old)})
+    notes = await llm(messages, max_tokens=250, purpose="notes", bot=bot)
+    if notes:
+        chat_set(chat_id, notes=notes[:1500])
+        log("notes updated for", chat_id)
+
+
+async def maybe_update_summary(chat_id):
+    """Когда из окна истории выпало SUMMARY_BATCH ещё не пересказанных
+    сообщений — дописываем их в пересказ. Пересказ растёт инкрементально:
+    в LLM уходит только старый пересказ и новый кусок, а не вся переписка."""
+    if HISTORY_TOKEN_BUDGET <= 0:
+        return
+    row = chat_get(chat_id)
+    _, first = history_window(chat_id)
+    if first is None:
+        return
+    with db() as c:
+        rows = c.execute(
+            "SELECT rowid, role, content FROM messages WHERE chat_id=? AND rowid>? AND rowid<? "
+            "ORDER BY rowid LIMIT ?", (chat_id, row["summary_rowid"], first, SUMMARY_BATCH * 4)).fetchall()
+    if len(rows) < SUMMARY_BATCH:
         return
+    dialog = "\n".join(f"{'я' if role == 'assistant' else 'он'}: {clip_to_tokens(text, 300)}"
+                       for _, role, text in rows)
+    bot = bot_of(chat_id)
+    summary = await llm([{"role": "user", "content": bot.prompts["summary"].format(
+        old_summary=row["summary"] or "нет", dialog=dialog)}], max_tokens=300, purpose="summary",
+        bot=bot)
+    chat_set(chat_id, summary=summary[:2000], summary_rowid=rows[-1][0])
+    log("summary updated for", chat_id)
+
+
+# ------------------------------------------------------------
+# ФОНОВЫЕ ЗАДАЧИ ПАМЯТИ
+# ------------------------------------------------------------
+# Заметки и пересказ раньше обновлялись прямо в process_dialog под локом
+# чата, и каждый NOTES_EVERY_N-й ответ ждал лишний запрос к LLM. Теперь
+# это строки в таблице jobs: одна на (вид, чат), так что повторные
+# постановки склеиваются, а перезапуск ничего не теряет. Воркеры берут
+# созревшие задачи с арендой (UPDATE ... WHERE due_ts=старое — как CAS,
+# безопасно для нескольких процессов над одной базой) и выполняют не
+# больше MEMORY_PARALLEL одновременно на лёгкой модели.
+
+JOB_HANDLERS = {"notes": update_notes, "summary": maybe_update_summary}
+
+_jobs_recent: dict = {}      # (вид, чат) -> когда ставили; чтобы не писать в базу каждый круг
+_jobs_running: set = set()
+
+
+def job_enqueue(kind, chat_id, delay=0):
+    now = time.time()
+    key = (kind, chat_id)
+    if now - _jobs_recent.get(key, 0) < MEMORY_DELAY_SEC:
+        return
+    _jobs_recent[key] = now
+    if len(_jobs_recent) > CHAT_CACHE_SIZE:
+        _jobs_recent.clear()
+    with _db_lock, db() as c:
+        c.execute("INSERT OR IGNORE INTO jobs(kind, chat_id, due_ts) VALUES (?,?,?)",
+                  (kind, chat_id, int(now + delay)))
+
+
+def jobs_cancel(chat_id):
+    with _db_lock, db() as c:
+        c.execute("DELETE FROM jobs WHERE chat_id=?", (chat_id,))
+
+
+def jobs_claim(now, limit):
+    """Берёт до limit созревших задач в аренду на JOB_LEASE_SEC."""
+    lease = now + JOB_LEASE_SEC
+    claimed = []
+    with _db_lock, db() as c:
+        rows = c.execute("SELECT kind, chat_id, due_ts, tries FROM jobs WHERE due_ts<=? "
+                         "ORDER BY due_ts LIMIT ?", (now, limit)).fetchall()
+        for kind, chat_id, due, tries in rows:
+            cur = c.execute("UPDATE jobs SET due_ts=? WHERE kind=? AND chat_id=? AND due_ts=?",
+                            (lease, kind, chat_id, due))
+            if cur.rowcount:
+                claimed.append((kind, chat_id, lease, tries))
+    return claimed
+
+
+def _job_finish(kind, chat_id, lease, due_ts=None, tries=None):
+    """Снимает задачу (due_ts=None) или откладывает её до due_ts."""
+    with _db_lock, db() as c:
+        if due_ts is None:
+            c.execute("DELETE FROM jobs WHERE kind=? AND chat_id=? AND due_ts=?", (kind, chat_id, lease))
+        else:
+            c.execute("UPDATE jobs SET due_ts=?, tries=? WHERE kind=? AND chat_id=? AND due_ts=?",
+                      (due_ts, tries, kind, chat_id, lease))
+
+
+async def run_job(kind, chat_id, lease, tries):
     try:
-        old = meta_get(f"notes:{chat_id}", "нет") or "нет"
-        messages = get_history(chat_id, 40)
-        messages.append({"role": "user",
-                         "content": NOTES_INSTRUCTION.format(old_notes=old)})
-        notes = llm(messages, max_tokens=250)
-        if notes:
-            meta_set(f"notes:{chat_id}", notes[:1500])
-            log("notes updated for", chat_id)
+        if chat_lock(chat_id).locked():
+            # человек как раз общается — не мешаем, заметки подождут
+            _job_finish(kind, chat_id, lease, int(time.time()) + MEMORY_DELAY_SEC, tries)
+            inc("annet_jobs_total", kind=kind, result="postponed")
+            return
+        try:
+            with timed(kind):
+                await JOB_HANDLERS[kind](chat_id)
+        except Exception as e:
+            log(f"{kind} job error chat", chat_id, repr(e))
+            if tries + 1 >= JOB_MAX_TRIES:
+                _job_finish(kind, chat_id, lease)
+                inc("annet_jobs_total", kind=kind, result="dropped")
+            else:
+                _job_finish(kind, chat_id, lease, int(time.time()) + 60 * 2 ** tries, tries + 1)
+                inc("annet_jobs_total", kind=kind, result="retry")
+            return
+        _job_finish(kind, chat_id, lease)
+        inc("annet_jobs_total", kind=kind, result="ok")
     except Exception as e:
-        log("notes error:", repr(e))
+        log("job bookkeeping error:", repr(e))   # аренда истечёт, задача вернётся
+    finally:
+        _jobs_running.discard((kind, chat_id))
+
+
+async def memory_loop():
+    while True:
+        await asyncio.sleep(MEMORY_TICK_SEC)
+        try:
+            free = MEMORY_PARALLEL - len(_jobs_running)
+            if free <= 0:
+                continue
+            for kind, chat_id, lease, tries in jobs_claim(int(time.time()), free):
+                if kind not in JOB_HANDLERS:
+                    _job_finish(kind, chat_id, lease)
+                    continue
+                _jobs_running.add((kind, chat_id))
+                task = asyncio.ensure_future(run_job(kind, chat_id, lease, tries))
+                _tasks.add(task)
+                task.add_done_callback(_tasks.discard)
+        except Exception as e:
+            log("memory loop error:", repr(e))
+
+
+def jobs_pending():
+    with db() as c:
+        return c.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
 
 
 # ------------------------------------------------------------
 # КОМАНДЫ
 # ------------------------------------------------------------
 
-def handle_command(chat_id, low):
+async def handle_command(chat_id, low):
     if low == "/start":
         clear_history(chat_id)
-        meta_set(f"notes:{chat_id}", "")
-        meta_set(f"msgcount:{chat_id}", 0)
-        send_human(chat_id, "о. новое лицо. ||| ну, привет. я аннет. и предупреждаю сразу — я тут не для того, чтобы поддакивать. (¬_¬) ||| как тебя звать-то?")
+        jobs_cancel(chat_id)
+        chat_set(chat_id, notes="", msgcount=0, summary="", summary_rowid=0)
+        await send_human(chat_id, bot_of(chat_id).lines["greeting"])
         return True
     if low == "/reset":
         clear_history(chat_id)
-        meta_set(f"notes:{chat_id}", "")
-        meta_set(f"msgcount:{chat_id}", 0)
-        send_human(chat_id, "всё, чистый лист. даже имя твоё стёрла. начинай заново производить впечатление.")
+        jobs_cancel(chat_id)
+        chat_set(chat_id, notes="", msgcount=0, summary="", summary_rowid=0)
+        await send_human(chat_id, bot_of(chat_id).lines["reset"])
         return True
     if low == "/silent":
-        meta_set(f"proactive:{chat_id}", "0")
-        send_human(chat_id, "поняла. первой писать не буду. ||| сам объявишься, когда станет скучно.")
+        chat_set(chat_id, proactive=0)
+        proactive_schedule(chat_id)
+        await send_human(chat_id, bot_of(chat_id).lines["silent"])
         return True
     if low == "/wake":
-        meta_set(f"proactive:{chat_id}", "1")
-        send_human(chat_id, "хорошо, буду иногда заглядывать сама. если будет о чем — а не по расписанию.")
+        chat_set(chat_id, proactive=1)
+        proactive_schedule(chat_id)
+        await send_human(chat_id, bot_of(chat_id).lines["wake"])
+        return True
+    if low in ("/context_on", "/context_off") and chat_id < 0:
+        on = low == "/context_on"
+        chat_set(chat_id, group_store=1 if on else 0)
+        await send_human(chat_id, bot_of(chat_id).lines["context_on" if on else "context_off"])
         return True
     return False
 
@@ -358,38 +2112,168 @@ def handle_command(chat_id, low):
 # ДИАЛОГ: один чат — один активный ответ
 # ------------------------------------------------------------
 
-def process_dialog(chat_id, user_name, reply_to=None):
+async def process_dialog(chat_id, user_name, reply_to=None):
     """Отвечает на всё, что накопилось в истории. Если во время генерации
     или отправки пришли новые сообщения — по завершении делает ещё один круг."""
     lock = chat_lock(chat_id)
-    if not lock.acquire(blocking=False):
+    if lock.locked():
         # уже отвечает: новое сообщение уже сохранено в историю,
         # активный цикл увидит его по счётчику и ответит следом
         return
-    sent_something = False
+    async with lock:
+        # счётчик другого воркера виден только после сброса буфера: без этого
+        # держатель аренды может выйти раньше, чем увидит наше сообщение
+        ingest_sync(chat_id)
+        if not coord.acquire(f"chat:{chat_id}", CHAT_LEASE_TTL):
+            return  # отвечает другой воркер — он тоже увидит новое по счётчику
+        try:
+            snapshot = await _dialog_rounds(chat_id, user_name, reply_to)
+        finally:
+            coord.release(f"chat:{chat_id}")
+    # страховка от гонки на самом выходе
+    if get_counter(chat_id) != snapshot:
+        await process_dialog(chat_id, user_name)
+
+
+async def _debounce(chat_id):
+    """Ждёт паузу в наборе: пока за DIALOG_DEBOUNCE_MS приходят новые
+    сообщения — ждём ещё, но не дольше четырёх окон."""
+    if DIALOG_DEBOUNCE_MS <= 0:
+        return
+    window = DIALOG_DEBOUNCE_MS / 1000
+    deadline = time.monotonic() + window * 4
+    seen = get_counter(chat_id)
+    while time.monotonic() < deadline:
+        await asyncio.sleep(window)
+        now = get_counter(chat_id)
+        if now == seen:
+            return
+        seen = now
+
+
+async def _reply_round(chat_id, user_name, reply_to, snapshot=None):
+    """Один ответ. Пока первый пузырь не ушёл, следит за счётчиком чата:
+    пришло новое (snapshot устарел) — отменяет генерацию вместе с запросом
+    к OpenRouter и возвращает False. Отправил — True. snapshot=None — не
+    прерывать."""
+    first_sent = asyncio.Event()
+
+    async def run():
+        if LLM_STREAM:
+            await stream_reply(chat_id, tg_name=user_name, reply_to=reply_to, first_sent=first_sent)
+        else:
+            reply = await llm_reply(chat_id, tg_name=user_name)
+            await send_human(chat_id, reply, reply_to, first_sent)
+
+    task = asyncio.ensure_future(run())
     try:
-        while True:
-            snapshot = get_counter(chat_id)
-            try:
-                reply = llm_reply(chat_id, tg_name=user_name)
-                send_human(chat_id, reply, reply_to)
-                sent_something = True
-                reply_to = None
-                maybe_update_notes(chat_id)
-            except Exception as e:
-                log("dialog error:", repr(e))
-                # сообщаем о сбое только если человек вообще остался без ответа
-                if not sent_something:
-                    send_text(chat_id, "у меня тут что-то технически заело... дай минуту и напиши ещё раз.")
+        while snapshot is not None and not first_sent.is_set():
+            done, _ = await asyncio.wait({task}, timeout=DIALOG_POLL_SEC)
+            if done:
                 break
-            if get_counter(chat_id) == snapshot:
-                break  # новых сообщений за время ответа не пришло
-            # пришли новые — идём на второй круг и отвечаем на них
+            # first_sent взводится в той же итерации цикла, что и уходит
+            # send_text, так что здесь задача гарантированно до отправки
+            if not first_sent.is_set() and get_counter(chat_id) != snapshot:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                inc("annet_dialog_restarts_total")
+                return False
+        await task
+        return True
     finally:
-        lock.release()
-    # страховка от гонки на самом выходе
-    if get_counter(chat_id) != snapshot:
-        process_dialog(chat_id, user_name)
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def _dialog_rounds(chat_id, user_name, reply_to):
+    """Круги ответа под локом чата; возвращает счётчик на начало последнего."""
+    sent_something = False
+    restarts = 0
+    while True:
+        await _debounce(chat_id)
+        snapshot = get_counter(chat_id)
+        coord.acquire(f"chat:{chat_id}", CHAT_LEASE_TTL)   # продлеваем аренду
+        try:
+            with timed("reply"):
+                # в группе не перезапускаем: новое обращение там обычно от
+                # другого человека, и ждать пришлось бы всем
+                watch = snapshot if chat_id > 0 and restarts < DIALOG_MAX_RESTARTS else None
+                if not await _reply_round(chat_id, user_name, reply_to, watch):
+                    restarts += 1
+                    continue   # человек дописал до первого пузыря — отвечаем сразу на всё
+            sent_something = True
+            restarts = 0
+            reply_to = None
+            schedule_memory(chat_id)
+        except Exception as e:
+            log("dialog error:", repr(e))
+            # сообщаем о сбое только если человек вообще остался без ответа
+            if not sent_something:
+                await send_text(chat_id, bot_of(chat_id).lines["error"])
+            return snapshot
+        if get_counter(chat_id) == snapshot:
+            return snapshot  # новых сообщений за время ответа не пришло
+        # пришли новые — идём на второй круг и отвечаем на них
+
+
+# ------------------------------------------------------------
+# ДИСПЕТЧЕР: фиксированное число воркеров и ограниченная очередь
+# ------------------------------------------------------------
+# Каждый апдейт раньше порождал свой поток. Теперь работа встаёт в очередь
+# с ключом: на один чат в очереди максимум одна задача (новые сообщения
+# только освежают её параметры), а если чат уже отвечает — активный цикл
+# process_dialog и так подхватит новое по счётчику. Когда ждущих чатов
+# больше DISPATCH_MAX_QUEUE, задачи сбрасываются: сообщение уже в истории,
+# и на него ответят вместе со следующим.
+
+_dispatch_q: asyncio.Queue = asyncio.Queue()
+_pending: dict = {}          # ключ -> фабрика корутины, ждущая воркера
+_dispatch_stats = {"accepted": 0, "coalesced": 0, "shed": 0,
+                   "running": 0, "peak_queue": 0}
+
+
+def _admit(key, factory):
+    if key[0] == "dialog" and chat_lock(key[1]).locked():
+        _dispatch_stats["coalesced"] += 1
+        return
+    if key in _pending:
+        _pending[key] = factory
+        _dispatch_stats["coalesced"] += 1
+        return
+    if len(_pending) >= DISPATCH_MAX_QUEUE:
+        _dispatch_stats["shed"] += 1
+        log("dispatch overloaded, shed:", key)
+        return
+    _pending[key] = factory
+    _dispatch_q.put_nowait(key)
+    _dispatch_stats["accepted"] += 1
+    _dispatch_stats["peak_queue"] = max(_dispatch_stats["peak_queue"], len(_pending))
+
+
+def dispatch(key, factory):
+    """Ставит задачу в очередь из любого потока. key — ("dialog", chat_id)
+    или ("cmd", chat_id, команда), factory — функция, возвращающая корутину."""
+    _loop.call_soon_threadsafe(_admit, key, factory)
+
+
+async def _dispatch_worker():
+    while True:
+        key = await _dispatch_q.get()
+        factory = _pending.pop(key, None)
+        if factory is None:
+            continue
+        _dispatch_stats["running"] += 1
+        try:
+            await factory()
+        except Exception as e:
+            log("dispatch error:", key, repr(e))
+        finally:
+            _dispatch_stats["running"] -= 1
+
+
+def dispatch_stats():
+    return dict(_dispatch_stats, queued=len(_pending))
 
 
 # ------------------------------------------------------------
@@ -402,104 +2286,267 @@ def in_quiet_hours():
     return QUIET_START <= h < QUIET_END
 
 
-def proactive_tick():
-    if in_quiet_hours():
+# Планировщик: для каждого чата заранее считаем момент, когда ему впервые
+# можно написать (тишина, зазор, дневной лимит, ночь), и держим эти моменты
+# в куче. Тик смотрит только на вершину кучи, так что его цена зависит от
+# числа созревших чатов, а не от всех. Созревшие генерируются параллельно,
+# не больше PROACTIVE_PARALLEL за раз. Устаревшие записи в куче не удаляем,
+# а пропускаем: актуальный срок чата лежит в _sched_due.
+
+_sched_heap: list = []       # (срок, chat_id)
+_sched_due: dict = {}        # chat_id -> актуальный срок
+_sched_lock = threading.Lock()
+_proactive_sem = asyncio.Semaphore(PROACTIVE_PARALLEL)
+
+
+def next_proactive_ts(row, now_ts, bot):
+    """Ближайший момент не раньше now_ts, когда чату можно написать первой,
+    или None, если уже не понадобится (выключено или молчит слишком долго)."""
+    if not row["proactive"] or not row["last_user_ts"]:
+        return None
+    lim = bot.limits
+    due = max(now_ts, row["last_user_ts"] + lim["min_silence_h"] * 3600,
+              row["last_proactive_ts"] + lim["gap_h"] * 3600)
+    for _ in range(4):
+        dt = datetime.fromtimestamp(due, TZ)
+        if row["day"] == dt.strftime("%Y-%m-%d") and row["day_count"] >= lim["cap_per_day"]:
+            due = int((dt + timedelta(days=1)).replace(hour=0, minute=0, second=0).timestamp())
+            continue
+        h = dt.hour + dt.minute / 60
+        if QUIET_START <= h < QUIET_END:
+            end = dt.replace(hour=int(QUIET_END), minute=int(QUIET_END % 1 * 60), second=0)
+            due = int(end.timestamp())
+            continue
+        break
+    if due > row["last_user_ts"] + lim["max_silence_d"] * 86400:
+        return None
+    return due
+
+
+def proactive_schedule_at(chat_id, due):
+    with _sched_lock:
+        if due is None:
+            _sched_due.pop(chat_id, None)
+            return
+        _sched_due[chat_id] = due
+        heapq.heappush(_sched_heap, (due, chat_id))
+        if len(_sched_heap) > 4 * len(_sched_due) + 1024:
+            # слишком много устаревших записей — пересобираем кучу
+            _sched_heap[:] = [(d, c) for c, d in _sched_due.items()]
+            heapq.heapify(_sched_heap)
+
+
+def proactive_schedule(chat_id, row=None):
+    """Пересчитывает срок чата по его строке в chats (после любых изменений)."""
+    bot = bot_of(chat_id)
+    if chat_id <= 0 or bot is None or not bot.proactive:
         return
-    today = now_msk().strftime("%Y-%m-%d")
-    now_ts = int(time.time())
+    proactive_schedule_at(chat_id, next_proactive_ts(row or chat_get(chat_id), int(time.time()), bot))
+
+
+def proactive_pop_due(now_ts):
+    due_chats = []
+    with _sched_lock:
+        while _sched_heap and _sched_heap[0][0] <= now_ts:
+            due, chat_id = heapq.heappop(_sched_heap)
+            if _sched_due.get(chat_id) == due:
+                del _sched_due[chat_id]
+                due_chats.append(chat_id)
+    return due_chats
 
-    for chat_id in known_private_chats():
-        try:
-            if meta_get(f"proactive:{chat_id}", "1") != "1":
-                continue
-            last_user = int(meta_get(f"last_user_ts:{chat_id}", 0) or 0)
-            if not last_user:
-                continue
-            gap_h = (now_ts - last_user) / 3600
-            if gap_h < PROACTIVE_MIN_SILENCE_H or gap_h > PROACTIVE_MAX_SILENCE_D * 24:
-                continue
-            last_pro = int(meta_get(f"last_proactive_ts:{chat_id}", 0) or 0)
-            if (now_ts - last_pro) / 3600 < PROACTIVE_GAP_H:
-                continue
-            count_key = f"proactive_count:{chat_id}:{today}"
-            if int(meta_get(count_key, 0) or 0) >= PROACTIVE_CAP_PER_DAY:
-                continue
-            if random.random() > PROACTIVE_PROB:
-                continue
 
-            lock = chat_lock(chat_id)
-            if not lock.acquire(blocking=False):
-                continue  # человек прямо сейчас общается — не влезаем
-            try:
-                text = llm_reply(chat_id,
-                                 extra_instruction=PROACTIVE_INSTRUCTION.format(gap_h=int(gap_h)),
-                                 hist_limit=14)
-                if text:
-                    send_human(chat_id, text)
-                    meta_set(f"last_proactive_ts:{chat_id}", now_ts)
-                    meta_set(count_key, int(meta_get(count_key, 0) or 0) + 1)
-                    log("proactive sent to", chat_id)
-            finally:
-                lock.release()
+def proactive_load(since_ts=None):
+    """Кладёт в кучу чаты из базы: при старте — все, кто ещё может получить
+    сообщение, потом — только писавшие с прошлой загрузки (в том числе через
+    другие воркеры, чьи вебхуки до этой кучи не доходят)."""
+    now_ts = int(time.time())
+    floor = now_ts - max(b.limits["max_silence_d"] for b in BOTS.values()) * 86400
+    rows = proactive_chats(max(floor, since_ts or 0))
+    for chat_id, row in rows:
+        proactive_schedule(chat_id, row)
+    if since_ts is None:
+        log("proactive scheduler: chats", len(rows), "scheduled", len(_sched_due))
+
+
+async def proactive_fire(chat_id):
+    async with _proactive_sem:
+        now_ts = int(time.time())
+        chat_cache_invalidate(chat_id)   # человек мог написать через другой воркер
+        row = chat_get(chat_id)
+        bot = bot_of(chat_id)
+        due = next_proactive_ts(row, now_ts, bot) if bot and bot.proactive else None
+        if due is None or due > now_ts:
+            proactive_schedule_at(chat_id, due)  # условия изменились, пока ждали
+            return
+        lock = chat_lock(chat_id)
+        # человек прямо сейчас общается — не влезаем; не выпал бросок — позже
+        if lock.locked() or random.random() > bot.limits["prob"]:
+            proactive_schedule_at(chat_id, now_ts + PROACTIVE_LOOP_SEC)
+            return
+        try:
+            gap_h = (now_ts - row["last_user_ts"]) / 3600
+            async with lock:
+                if not coord.acquire(f"chat:{chat_id}", CHAT_LEASE_TTL):
+                    proactive_schedule_at(chat_id, now_ts + PROACTIVE_LOOP_SEC)
+                    return
+                try:
+                    text = await llm_reply(chat_id,
+                                           extra_instruction=bot.prompts["proactive"].format(gap_h=int(gap_h)),
+                                           hist_limit=14, purpose="proactive")
+                    if text:
+                        await send_human(chat_id, text)
+                        chat_mark_proactive(chat_id, now_ts, now_msk().strftime("%Y-%m-%d"))
+                        log("proactive sent to", chat_id)
+                finally:
+                    coord.release(f"chat:{chat_id}")
+            proactive_schedule(chat_id)
         except Exception as e:
             log("proactive error chat", chat_id, repr(e))
+            proactive_schedule_at(chat_id, now_ts + PROACTIVE_LOOP_SEC)
+
+
+async def proactive_tick():
+    if in_quiet_hours():
+        return
+    for chat_id in proactive_pop_due(int(time.time())):
+        spawn(proactive_fire(chat_id))
 
 
-def proactive_loop():
+async def proactive_loop():
+    proactive_load()
+    loaded_at = time.time()
     while True:
         try:
-            proactive_tick()
+            if time.time() - loaded_at > PROACTIVE_LOOP_SEC:
+                proactive_load(int(loaded_at) - PROACTIVE_TICK_SEC)
+                loaded_at = time.time()
+            await proactive_tick()
         except Exception as e:
             log("proactive loop error:", repr(e))
-        time.sleep(PROACTIVE_LOOP_SEC)
+        await asyncio.sleep(PROACTIVE_TICK_SEC)
+
+
+async def leader_loop():
+    """Планировщик проактивности крутится ровно в одном воркере — у того,
+    кто держит аренду proactive-leader. Упал лидер — аренду через LEADER_TTL
+    подхватит другой."""
+    task = None
+    while True:
+        try:
+            leader = coord.acquire("proactive-leader", LEADER_TTL)
+        except Exception as e:
+            log("leader lease error:", repr(e))
+            leader = False
+        if leader and task is None:
+            log("proactive leader:", NODE_ID)
+            task = _loop.create_task(proactive_loop())
+        elif not leader and task is not None:
+            log("proactive leadership lost")
+            task.cancel()
+            task = None
+        await asyncio.sleep(LEADER_TTL / 3)
 
 
 # ------------------------------------------------------------
 # ВЕБХУК
 # ------------------------------------------------------------
 
-def should_reply_in_group(msg):
-    text = msg.get("text", "")
-    if BOT_USERNAME and f"@{BOT_USERNAME}".lower() in text.lower():
-        return True
-    if re.search(r"\bаннет\b", text, re.IGNORECASE):
-        return True
-    reply = msg.get("reply_to_message") or {}
-    if BOT_USERNAME and (reply.get("from") or {}).get("username", "").lower() == BOT_USERNAME.lower():
-        return True
-    return False
-
+@lru_cache(maxsize=64)
+def _trigger_re(names, username):
+    """Одна скомпилированная регулярка на все имена, прозвища и @username
+    бота: текст группы просматривается за один проход. Перестраивается,
+    только когда getMe вернул другое имя бота."""
+    names = sorted(list(names) + ([f"@{username}"] if username else []), key=len, reverse=True)
+    if not names:
+        return re.compile(r"(?!x)x")   # ни на что не откликается
+    return re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, names)) + r")(?!\w)", re.IGNORECASE)
 
-@app.get("/")
-def home():
-    return "Annet is alive."
-
-
-@app.get("/health")
-def health():
-    return "ok"
 
+def should_reply_in_group(msg, bot=None):
+    bot = bot or DEFAULT_BOT
+    if _trigger_re(bot.names, bot.username).search(msg.get("text", "")):
+        return True
+    reply = msg.get("reply_to_message") or {}
+    who = (reply.get("from") or {}).get("username")
+    return bool(bot.username and who and who.casefold() == bot.username.casefold())
+
+
+def group_stores(chat_id):
+    flag = chat_get(chat_id)["group_store"]
+    return GROUP_STORE if flag < 0 else bool(flag)
+
+
+_RAW_UPDATE_ID = re.compile(rb'"update_id"\s*:\s*(\d+)')
+_RAW_DATE = re.compile(rb'"date"\s*:\s*(\d+)')
+_RAW_CHAT_ID = re.compile(rb'"chat"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+_RAW_GROUP = re.compile(rb'"type"\s*:\s*"(?:super)?group"')
+_RAW_COMMAND = re.compile(rb'"text"\s*:\s*"/')
+
+
+def _raw_group_ignored(raw, bot):
+    """Сообщение группы, которая отказалась от контекста (/context_off), и
+    явно не к боту: не команда, не ответ на сообщение, без имени бота в теле.
+    Имя ищем по всему телу — лишнее совпадение (в названии группы, в имени
+    отправителя) лишь отправит апдейт на полный разбор. Тело с \\u-экранами
+    пропускаем: имя там по байтам не найти."""
+    if not _RAW_GROUP.search(raw) or b"\\u" in raw or b'"reply_to_message"' in raw \
+            or _RAW_COMMAND.search(raw):
+        return False
+    m = _RAW_CHAT_ID.search(raw)
+    if not m or group_stores(bot.key(int(m.group(1)))):
+        return False
+    return not _trigger_re(bot.names, bot.username).search(raw.decode("utf-8", "ignore"))
+
+
+def parse_update(raw, bot=None):
+    """Предфильтр по сырому телу вебхука, до разбора JSON: без "text" —
+    не наш апдейт; первая "date" (у message она идёт раньше вложенных
+    объектов с датами) старше MAX_MSG_AGE_SEC — поздно отвечать; группа без
+    контекста и не к боту — молча мимо; update_id уже видели — повтор.
+    Прошедшее разбирается и отдаётся как dict, иначе None."""
+    if b'"text"' not in raw:
+        inc("annet_updates_total", result="not_text")
+        return None
+    m = _RAW_DATE.search(raw)
+    if m and int(m.group(1)) < time.time() - MAX_MSG_AGE_SEC:
+        inc("annet_updates_total", result="too_old")
+        return None
+    bot = bot or DEFAULT_BOT
+    if _raw_group_ignored(raw, bot):
+        inc("annet_updates_total", result="group_ignored")
+        return None
+    m = _RAW_UPDATE_ID.search(raw)
+    if m and coord.seen(bot.key(int(m.group(1)))):
+        inc("annet_updates_total", result="duplicate")
+        return None
+    try:
+        upd = json.loads(raw)
+    except ValueError:
+        return None
+    return upd if isinstance(upd, dict) else None
 
-@app.post(f"/webhook/{WEBHOOK_SECRET}")
-def webhook():
-    upd = request.json or {}
 
+def handle_update(upd, dedup=True, bot=None):
+    """Общая для Flask и ASGI часть вебхука: быстрые проверки и запись в базу,
+    а сам ответ уходит корутиной в цикл бота. dedup=False — повтор update_id
+    уже отсеял parse_update. Дальше chat_id — ключ чата в общих таблицах."""
+    bot = bot or DEFAULT_BOT
     upd_id = upd.get("update_id")
-    if upd_id is not None:
-        with _seen_lock:
-            if upd_id in _seen_updates:
-                return "ok"
-            _seen_updates.append(upd_id)
+    if dedup and upd_id is not None and coord.seen(bot.key(upd_id)):
+        inc("annet_updates_total", result="duplicate")
+        return
 
     msg = upd.get("message")
     if not msg or not msg.get("text"):
-        return "ok"
+        inc("annet_updates_total", result="not_text")
+        return
 
     if int(msg.get("date", 0)) < time.time() - MAX_MSG_AGE_SEC:
-        return "ok"
+        inc("annet_updates_total", result="too_old")
+        return
 
     chat = msg.get("chat", {})
-    chat_id = chat.get("id")
+    chat_id = bot.key(chat.get("id") or 0)
     chat_type = chat.get("type", "")
     text = msg["text"].strip()
     from_user = msg.get("from") or {}
@@ -508,45 +2555,268 @@ def webhook():
     # команды — отдельно, в историю не пишем
     if text.startswith("/"):
         low = text.lower().split("@")[0].strip()
-        threading.Thread(target=handle_command, args=(chat_id, low), daemon=True).start()
-        return "ok"
+        dispatch(("cmd", chat_id, low), lambda: handle_command(chat_id, low))
+        inc("annet_updates_total", result="command")
+        return
 
     is_group = chat_type in ("group", "supergroup")
+    triggered = not is_group or should_reply_in_group(msg, bot)
+    if not triggered and not group_stores(chat_id):
+        inc("annet_updates_total", result="group_ignored")
+        return
+
+    # сохраняем сообщение сразу (до генерации), чтобы очередь работала;
+    # в базу оно попадёт пачкой, но история чата его уже увидит
+    ingest_user_message(chat_id, f"{user_name}: {text}" if is_group else text, asks=triggered)
+    proactive_schedule(chat_id)
 
-    # сохраняем сообщение сразу (до генерации), чтобы очередь работала
-    save_message(chat_id, "user", f"{user_name}: {text}" if is_group else text)
-    meta_set(f"last_user_ts:{chat_id}", int(time.time()))
-    bump_counter(chat_id)
+    if not triggered:
+        inc("annet_updates_total", result="group_stored")
+        return
+
+    reply_to = msg.get("message_id") if is_group else None
+    dispatch(("dialog", chat_id), lambda: process_dialog(chat_id, user_name, reply_to))
+    inc("annet_updates_total", result="dialog")
+
+
+def current_gauges():
+    """Мгновенные значения для /metrics: очереди, локи, пул и счётчики подсистем."""
+    gauges = {"annet_active_chat_locks": sum(1 for lk in list(_chat_locks.values()) if lk.locked()),
+              "annet_db_pool_idle": _db_pool.qsize(),
+              "annet_proactive_scheduled": len(_sched_due),
+              "annet_ingest_pending": len(_ingest_msgs),
+              "annet_llm_breakers_open": breakers_open(),
+              "annet_jobs_running": len(_jobs_running),
+              "annet_jobs_pending": jobs_pending()}
+    for prefix, stats in (("dispatch", dispatch_stats()), ("tg", tg_stats()),
+                          ("llm", llm_stats()), ("ingest", _ingest_stats)):
+        for k, v in stats.items():
+            gauges[f"annet_{prefix}_{k}"] = v
+    return gauges
+
+
+@app.get("/")
+def home():
+    return "Annet is alive."
 
-    if is_group and not should_reply_in_group(msg):
-        return "ok"
 
-    threading.Thread(target=process_dialog,
-                     args=(chat_id, user_name, msg.get("message_id") if is_group else None),
-                     daemon=True).start()
+@app.before_request
+def _ensure_started():
+    startup()   # запуск как gunicorn app:app — поднимаемся на первом запросе
+
+
+@app.get("/health")
+def health():
     return "ok"
 
 
+@app.get("/ready")
+def readiness():
+    return json.dumps(_boot), 200 if ready() else 503, {"Content-Type": "application/json"}
+
+
+@app.get("/metrics")
+def metrics():
+    return render_metrics(current_gauges()), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@app.get("/debug/profile")
+def debug_profile():
+    if PROFILE_SAMPLE_HZ <= 0:
+        return "profiler disabled (PROFILE_SAMPLE_HZ=0)", 404
+    return render_profile(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+@app.post("/webhook/<secret>")
+def webhook(secret):
+    bot = BOTS_BY_SECRET.get(secret)
+    if bot is None:
+        return "not found", 404
+    with timed("webhook"):
+        upd = parse_update(request.get_data(), bot)
+        if upd is not None:
+            handle_update(upd, dedup=False, bot=bot)
+    return "ok"
+
+
+async def asgi_app(scope, receive, send):
+    """Тот же вебхук как ASGI-приложение: uvicorn app:asgi_app."""
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await asyncio.to_thread(shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    startup()
+
+    status, body = 404, b"not found"
+    path, method = scope["path"], scope["method"]
+    if method == "GET" and path == "/":
+        status, body = 200, "Annet is alive.".encode()
+    elif method == "GET" and path == "/health":
+        status, body = 200, b"ok"
+    elif method == "GET" and path == "/ready":
+        status, body = 200 if ready() else 503, json.dumps(_boot).encode()
+    elif method == "GET" and path == "/metrics":
+        status, body = 200, render_metrics(current_gauges()).encode()
+    elif method == "GET" and path == "/debug/profile" and PROFILE_SAMPLE_HZ > 0:
+        status, body = 200, render_profile().encode()
+    elif method == "POST" and path.startswith("/webhook/") and path[9:] in BOTS_BY_SECRET:
+        bot = BOTS_BY_SECRET[path[9:]]
+        raw = b""
+        while True:
+            event = await receive()
+            raw += event.get("body", b"")
+            if not event.get("more_body"):
+                break
+        with timed("webhook"):
+            upd = parse_update(raw, bot)
+            if upd is not None:
+                handle_update(upd, dedup=False, bot=bot)
+        status, body = 200, b"ok"
+
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": body})
+
+
 # ------------------------------------------------------------
-# СТАРТ
+# СТАРТ: жизненный цикл воркера
 # ------------------------------------------------------------
+# Импорт модуля ничего не делает. startup() поднимает базу и цикл бота за
+# миллисекунды, а всё сетевое (getMe, проверка и установка вебхука) идёт
+# фоном с повторами: воркер сразу принимает запросы, а /ready отвечает 200,
+# когда бот знает своё имя. Вебхук ставится, только если getWebhookInfo
+# показывает другой адрес, и без drop_pending_updates — перезапуск не
+# теряет сообщения, которые Telegram копил, пока воркер поднимался.
 
-init_db()
+_boot = {"db": False, "runtime": False, "telegram": False, "webhook": False}
+_boot_lock = threading.Lock()
+_started = False
 
-if TG_TOKEN:
-    me = tg("getMe", {})
-    BOT_USERNAME = ((me.get("result") or {}).get("username") or "")
-    log("bot username:", BOT_USERNAME)
-    log("model:", MODEL)
 
-    if PUBLIC_URL:
-        tg("setWebhook", {"url": f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}",
-                          "drop_pending_updates": True})
-        log("webhook set")
-    else:
+_bots_named: set = set()      # боты, чьё имя уже подтвердил getMe
+_bots_hooked: set = set()
+
+
+async def bootstrap_telegram(bot):
+    delay = 1
+    while bot.id not in _bots_named:
+        try:
+            me = await tg("getMe", {}, bot)
+            if not me.get("ok"):
+                raise RuntimeError(f"getMe: {str(me)[:200]}")
+            name = (me.get("result") or {}).get("username") or ""
+            if name != bot.username:
+                bot.username = name
+                meta_set(bot.meta_key, name)
+            log(f"bot {bot.id} username:", bot.username)
+            _bots_named.add(bot.id)
+        except Exception as e:
+            log(f"bot {bot.id} telegram bootstrap failed, retry in", delay, "s:", repr(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    _boot["telegram"] = all(b.id in _bots_named for b in BOTS.values() if b.token)
+    if not PUBLIC_URL:
         log("PUBLIC_URL/RENDER_EXTERNAL_URL не задан — вебхук не установлен!")
-else:
-    log("TG_TOKEN не задан!")
+        return
+    url = f"{PUBLIC_URL}/webhook/{bot.secret}"
+    delay = 1
+    while bot.id not in _bots_hooked:
+        try:
+            info = await tg("getWebhookInfo", {}, bot)
+            if (info.get("result") or {}).get("url") != url:
+                res = await tg("setWebhook", {"url": url}, bot)
+                if not res.get("ok"):
+                    raise RuntimeError(f"setWebhook: {str(res)[:200]}")
+                log(f"bot {bot.id} webhook set")
+            else:
+                log(f"bot {bot.id} webhook already set, pending:",
+                    (info.get("result") or {}).get("pending_update_count", 0))
+            _bots_hooked.add(bot.id)
+        except Exception as e:
+            log(f"bot {bot.id} webhook setup failed, retry in", delay, "s:", repr(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    _boot["webhook"] = all(b.id in _bots_hooked for b in BOTS.values() if b.token)
+
+
+def startup():
+    """Поднимает воркер: база, цикл бота, фоновые задачи. Идемпотентна и
+    быстра — сеть не трогает, Telegram настраивается фоном."""
+    global _started
+    if _started:
+        return
+    with _boot_lock:
+        if _started:
+            return
+        t0 = time.perf_counter()
+        init_db()
+        if COMPACT_EVERY_SEC > 0:
+            enable_incremental_vacuum()
+        _boot["db"] = True
+        for bot in BOTS.values():
+            bot.username = meta_get(bot.meta_key, "") or ""   # пока getMe не ответил
+        start_runtime()
+        _boot["runtime"] = True
+        log("model:", DEFAULT_BOT.models["reply"], "light:", DEFAULT_BOT.models["notes"],
+            "fallbacks:", ",".join(MODEL_FALLBACKS) or "нет")
+        if not TG_TOKEN:
+            log("TG_TOKEN не задан!")
+        for bot in BOTS.values():
+            if bot.token:
+                spawn(bootstrap_telegram(bot))
+        if len(BOTS) > 1:
+            log("bots:", ", ".join(f"{b.id}:{b.name}" for b in BOTS.values()))
+        if any(b.proactive for b in BOTS.values()):
+            spawn(leader_loop())
+        if COMPACT_EVERY_SEC > 0:
+            spawn(compaction_loop())
+        if PROFILE_SAMPLE_HZ > 0:
+            threading.Thread(target=_profile_loop, name="annet-profiler", daemon=True).start()
+        atexit.register(shutdown)
+        _started = True
+        log(f"started in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+
+async def _stop_tasks():
+    current = asyncio.current_task()
+    tasks = [t for t in asyncio.all_tasks() if t is not current]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+def shutdown():
+    """Останавливает воркер: сбрасывает буфер сообщений, гасит задачи и
+    закрывает HTTP-клиенты. Вызывается из lifespan ASGI и при выходе."""
+    global _started
+    if not _started:
+        return
+    _started = False
+    try:
+        ingest_flush()
+        run_sync(_stop_tasks(), timeout=5)
+    except Exception as e:
+        log("shutdown error:", repr(e))
+    _loop.call_soon_threadsafe(_loop.stop)
+
+
+def ready():
+    return _boot["db"] and _boot["runtime"] and (
+        _boot["telegram"] or not any(b.token for b in BOTS.values()))
+
 
-if PROACTIVE_ENABLED:
-    threading.Thread(target=proactive_loop, daemon=True).start()
+def create_app():
+    """Фабрика для gunicorn 'app:create_app()': поднимает воркер и отдаёт Flask-приложение."""
+    startup()
+    return app
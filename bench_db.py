@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# ============================================================
+#  Микробенчмарк БД на пути вебхука: N чатов одновременно делают
+#  то же, что делает один входящий апдейт (save_message, meta_set,
+#  get_history, meta_get). Сравнивает пул соединений с прежней схемой
+#  «новое соединение + PRAGMA под общим локом».
+#
+#  Запуск: python bench_db.py [чатов=50] [сообщений_на_чат=40]
+# ============================================================
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ["PROACTIVE_ENABLED"] = "0"
+os.environ.pop("TG_TOKEN", None)
+
+import app  # noqa: E402
+
+
+def legacy_db():
+    conn = sqlite3.connect(app.DB_PATH, timeout=15)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def legacy_path(chat_id, text):
+    with app._db_lock, legacy_db() as c:
+        c.execute("INSERT INTO messages VALUES (?,?,?,?)", (chat_id, "user", text, int(time.time())))
+    with app._db_lock, legacy_db() as c:
+        c.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (f"bench:{chat_id}", str(time.time())))
+    with app._db_lock, legacy_db() as c:
+        c.execute("SELECT role, content FROM messages WHERE chat_id=? ORDER BY ts DESC, rowid DESC LIMIT ?",
+                  (chat_id, app.HISTORY_LIMIT)).fetchall()
+    with app._db_lock, legacy_db() as c:
+        c.execute("SELECT value FROM meta WHERE key=?", (f"bench:{chat_id}",)).fetchone()
+
+
+def pooled_path(chat_id, text):
+    app.save_message(chat_id, "user", text)
+    app.meta_set(f"bench:{chat_id}", time.time())
+    app.get_history(chat_id)
+    app.meta_get(f"bench:{chat_id}")
+
+
+def run(name, fn, chats, per_chat):
+    lat = []
+    lat_lock = threading.Lock()
+
+    def worker(chat_id):
+        mine = []
+        for i in range(per_chat):
+            t0 = time.perf_counter()
+            fn(chat_id, f"сообщение {i} " * 8)
+            mine.append(time.perf_counter() - t0)
+        with lat_lock:
+            lat.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(1000 + c,)) for c in range(chats)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - t0
+    lat.sort()
+    p = lambda q: lat[min(len(lat) - 1, int(len(lat) * q))] * 1000
+    print(f"{name:8s} апдейтов={len(lat):5d}  {len(lat) / total:8.0f}/с  "
+          f"p50={p(0.5):7.2f}мс  p99={p(0.99):7.2f}мс")
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_chat = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    app.init_db()
+    print(f"база: {app.DB_PATH}, чатов: {chats}, апдейтов на чат: {per_chat}")
+    run("legacy", legacy_path, chats, per_chat)
+    run("pooled", pooled_path, chats, per_chat)
+
+
+if __name__ == "__main__":
+    main()
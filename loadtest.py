@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# ============================================================
+#  Нагрузочный стенд без интернета: поднимает локальные заглушки
+#  Telegram Bot API и OpenRouter (с задержками, 429 и пустыми ответами),
+#  гонит через вебхук app синтетический трафик — личные чаты, всплески в
+#  группах, повторные update_id — и печатает:
+#    p50/p99 обработки вебхука, p50/p99 времени до первого пузыря,
+#    пик числа потоков, запросов к SQLite на апдейт, счётчики бота,
+#    время холодного старта до первого ответа и до готовности (/ready).
+#
+#  Запуск: python loadtest.py --chats 50 --msgs 4 --groups 3 --burst 40
+#          python loadtest.py --proactive 200   # заодно прогнать проактивность
+# ============================================================
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLIES = [
+    "ну привет, раз пришёл.",
+    "хм. ||| и что ты этим хочешь сказать? (¬_¬)",
+    "слушай, я тут подумала...\nа ты вообще спишь когда-нибудь?",
+    "не знаю. ||| н-ну и что. ||| давай лучше про крабовые чипсы.",
+]
+
+
+class Mock:
+    """Поведение заглушек и журнал того, что бот им отправил."""
+
+    def __init__(self, args):
+        self.tg_latency = args.tg_latency / 1000
+        self.llm_ttft = args.llm_ttft / 1000
+        self.llm_token = args.llm_token / 1000
+        self.tg_429 = args.tg_429
+        self.llm_empty = args.llm_empty
+        self.lock = threading.Lock()
+        self.sends = []          # (monotonic, chat_id) для sendMessage
+        self.calls = {}          # метод -> сколько раз звали
+
+    def note(self, method, chat_id=None):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == "sendMessage":
+                self.sends.append((time.monotonic(), chat_id))
+
+
+MOCK: Mock = None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *a):
+        pass
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = json.loads(raw or b"{}")
+        try:
+            if self.path.endswith("/chat/completions"):
+                self._llm(body)
+            elif "/bot" in self.path:
+                self._tg(self.path.rsplit("/", 1)[-1], body)
+            else:
+                self._json(404, {"ok": False})
+        except (BrokenPipeError, ConnectionResetError):
+            MOCK.note("aborted")   # бот отменил запрос (человек дописал до ответа)
+
+    def _json(self, code, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _tg(self, method, body):
+        time.sleep(MOCK.tg_latency)
+        if method == "sendMessage" and random.random() < MOCK.tg_429:
+            MOCK.note("429")
+            return self._json(429, {"ok": False, "error_code": 429,
+                                    "parameters": {"retry_after": 1}})
+        MOCK.note(method, body.get("chat_id"))
+        if method == "getMe":
+            return self._json(200, {"ok": True, "result": {"username": "annet_bench_bot"}})
+        if method == "getWebhookInfo":
+            return self._json(200, {"ok": True, "result": {"url": ""}})
+        self._json(200, {"ok": True, "result": True})
+
+    def _llm(self, body):
+        MOCK.note("completion")
+        time.sleep(MOCK.llm_ttft)
+        text = "" if random.random() < MOCK.llm_empty else random.choice(REPLIES)
+        usage = {"prompt_tokens": sum(len(str(m.get("content"))) for m in body.get("messages", [])) // 3,
+                 "completion_tokens": len(text) // 3}
+        if not body.get("stream"):
+            return self._json(200, {"choices": [{"message": {"content": text}}], "usage": usage})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i in range(0, len(text), 4):
+            chunk = {"choices": [{"delta": {"content": text[i:i + 4]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(MOCK.llm_token)
+        final = {"choices": [{"delta": {}}], "usage": usage}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+
+
+def start_mock(args):
+    global MOCK
+    MOCK = Mock(args)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=50, help="личных чатов")
+    ap.add_argument("--msgs", type=int, default=4, help="сообщений на личный чат")
+    ap.add_argument("--think", type=float, default=1.5, help="средняя пауза между сообщениями, с")
+    ap.add_argument("--groups", type=int, default=3, help="групп со всплеском")
+    ap.add_argument("--burst", type=int, default=40, help="сообщений во всплеске группы")
+    ap.add_argument("--mention", type=float, default=0.1, help="доля сообщений группы с обращением к боту")
+    ap.add_argument("--dups", type=float, default=0.05, help="доля повторно доставленных update_id")
+    ap.add_argument("--proactive", type=int, default=0, help="чатов для прогона проактивности")
+    ap.add_argument("--tg-latency", type=float, default=30, help="задержка Telegram, мс")
+    ap.add_argument("--tg-429", type=float, default=0.02, help="доля 429 на sendMessage")
+    ap.add_argument("--llm-ttft", type=float, default=800, help="время до первого токена, мс")
+    ap.add_argument("--llm-token", type=float, default=15, help="пауза между кусками потока, мс")
+    ap.add_argument("--llm-empty", type=float, default=0.03, help="доля пустых ответов модели")
+    ap.add_argument("--timeout", type=float, default=120, help="сколько ждать, пока бот всё допишет, с")
+    args = ap.parse_args()
+
+    base = start_mock(args)
+    os.environ.update({
+        "TG_TOKEN": "BENCH", "TG_API_BASE": base, "OPENROUTER_API": f"{base}/api/v1",
+        "OPENROUTER_API_KEY": "bench", "WEBHOOK_SECRET": "bench", "PUBLIC_URL": "",
+        "DB_PATH": os.path.join(tempfile.mkdtemp(), "loadtest.db"),
+        "PROACTIVE_ENABLED": "0", "COMPACT_EVERY_SEC": "0",
+    })
+    os.environ.setdefault("TG_GLOBAL_RATE", "1000")
+
+    t_boot = time.monotonic()
+    import app  # noqa: E402  — импорт после подмены окружения
+    boot_client = app.app.test_client()
+    boot_client.get("/health")                 # первый запрос поднимает воркер
+    t_first = time.monotonic() - t_boot
+    while boot_client.get("/ready").status_code != 200:
+        time.sleep(0.02)
+    t_ready = time.monotonic() - t_boot
+
+    db_ops = [0]
+    connect = app._db_connect
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(lambda sql: db_ops.__setitem__(0, db_ops[0] + 1))
+        return conn
+
+    app._db_connect = traced_connect
+    while not app._db_pool.empty():   # соединения из init_db — без трассировки
+        app._db_pool.get_nowait().close()
+
+    peak_threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def sample_threads():
+        while not stop.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.05)
+
+    threading.Thread(target=sample_threads, daemon=True).start()
+
+    lat_lock = threading.Lock()
+    webhook_lat = []
+    user_msgs = []           # (monotonic, chat_id) — сообщения, на которые ждём ответ
+    upd_counter = [0]
+
+    def post(client, chat_id, chat_type, text, answered):
+        with lat_lock:
+            upd_counter[0] += 1
+            upd_id = upd_counter[0]
+        upd = {"update_id": upd_id, "message": {
+            "message_id": upd_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": {"first_name": f"user{abs(chat_id) % 97}"}}}
+        for _ in range(2 if random.random() < args.dups else 1):
+            t0 = time.monotonic()
+            client.post("/webhook/bench", json=upd)
+            with lat_lock:
+                webhook_lat.append(time.monotonic() - t0)
+                if answered and _ == 0:
+                    user_msgs.append((t0, chat_id))
+
+    def private_chat(chat_id):
+        client = app.app.test_client()
+        for i in range(args.msgs):
+            post(client, chat_id, "private", f"сообщение {i} от {chat_id}", True)
+            time.sleep(random.expovariate(1 / args.think))
+
+    def group_burst(chat_id):
+        client = app.app.test_client()
+        for i in range(args.burst):
+            mention = random.random() < args.mention
+            post(client, chat_id, "supergroup", ("аннет, " if mention else "") + f"болтаем {i}", mention)
+            time.sleep(random.uniform(0, 0.05))
+
+    if args.proactive:
+        run_proactive(app, args)
+
+    n_updates_before = db_ops[0]
+    t_start = time.monotonic()
+    threads = [threading.Thread(target=private_chat, args=(1000 + c,)) for c in range(args.chats)]
+    threads += [threading.Thread(target=group_burst, args=(-1000 - g,)) for g in range(args.groups)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    t_traffic = time.monotonic() - t_start
+
+    # ждём, пока бот допишет всё, что начал
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        stats = app.run_sync(_idle_stats(app))
+        with MOCK.lock:
+            last_send = MOCK.sends[-1][0] if MOCK.sends else 0
+        if not stats["running"] and not stats["queued"] and time.monotonic() - last_send > 3:
+            break
+        time.sleep(0.5)
+    stop.set()
+
+    with MOCK.lock:
+        sends = list(MOCK.sends)
+        calls = dict(MOCK.calls)
+    ttfb, unanswered = [], 0
+    for t0, chat_id in user_msgs:
+        first = next((t for t, c in sends if c == chat_id and t >= t0), None)
+        if first is None:
+            unanswered += 1
+        else:
+            ttfb.append(first - t0)
+
+    n = upd_counter[0]
+    print(f"старт:          первый ответ через {t_first * 1000:.0f} мс, готов через {t_ready * 1000:.0f} мс")
+    print(f"апдейтов: {n} за {t_traffic:.1f} с, ждали ответа: {len(user_msgs)}, без ответа: {unanswered}")
+    print(f"вебхук:         p50={pct(webhook_lat, .5) * 1000:7.2f} мс  p99={pct(webhook_lat, .99) * 1000:7.2f} мс")
+    print(f"первый пузырь:  p50={pct(ttfb, .5):7.2f} с   p99={pct(ttfb, .99):7.2f} с")
+    print(f"потоков (пик):  {peak_threads[0]} (вместе с потоками стенда и заглушек)")
+    print(f"SQLite на апдейт: {(db_ops[0] - n_updates_before) / max(n, 1):.1f} запросов")
+    print("заглушки:", calls)
+    print("диспетчер:", app.dispatch_stats())
+    print("telegram:", app.tg_stats())
+    print("llm:", app.llm_stats())
+
+
+async def _idle_stats(app):
+    return app.dispatch_stats()
+
+
+def run_proactive(app, args):
+    """Засевает чаты, молчащие 7 часов, и меряет, за сколько планировщик
+    разошлёт им всем проактивные сообщения."""
+    app.DEFAULT_BOT.proactive = True
+    app.DEFAULT_BOT.limits["prob"] = 1.0
+    app.QUIET_START = app.QUIET_END = 0.0   # ночь стенду не помеха
+    silent_since = int(time.time()) - 7 * 3600
+    chats = [50000 + i for i in range(args.proactive)]
+    for chat_id in chats:
+        app.save_message(chat_id, "user", "ну всё, я спать")
+        app.chat_set(chat_id, last_user_ts=silent_since)
+    with MOCK.lock:
+        before = len(MOCK.sends)
+    t0 = time.monotonic()
+    app.proactive_load()
+    app.run_sync(app.proactive_tick())
+    while time.monotonic() - t0 < args.timeout:
+        with MOCK.lock:
+            reached = {c for _, c in MOCK.sends[before:]}
+        if len(reached & set(chats)) >= len(chats):
+            break
+        time.sleep(0.2)
+    print(f"проактивность: {len(reached & set(chats))}/{len(chats)} чатов за "
+          f"{time.monotonic() - t0:.1f} с (параллельно {app.PROACTIVE_PARALLEL})")
+    app.DEFAULT_BOT.proactive = False
+
+
+if __name__ == "__main__":
+    main()